@@ -0,0 +1,100 @@
+"""Сравнение профилей кодирования: число запросов к Whisper, размер и WER.
+
+Запуск (нужен OPENAI_API_KEY, вызовы Whisper платные):
+    python benchmarks/encoding_profiles.py samples/ --profiles mp3:64,mp3:32,opus:24
+
+Для каждого файла samples/<имя>.<ext> эталонная расшифровка берется из
+samples/<имя>.txt, если она есть; без эталона WER не считается.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py читает их при импорте; боту и таблицам бенчмарк не обращается
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("GS_PRIVATE_KEY", "")
+
+import main  # noqa: E402
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    """WER по словам без учета регистра и пунктуации"""
+    ref = [w for w in map(main._normalize_word, reference.split()) if w]
+    hyp = [w for w in map(main._normalize_word, hypothesis.split()) if w]
+    if not ref:
+        return 0.0
+    previous = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        current = [i]
+        for j, h in enumerate(hyp, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (r != h)))
+        previous = current
+    return previous[-1] / len(ref)
+
+
+async def bench_file(path: str, profile: main.EncodingProfile) -> dict:
+    source = await main.probe_media(path)
+    prepared = await main.prepare_audio(source, profile)
+    try:
+        if prepared.size <= main.MAX_FILE_SIZE:
+            requests = 1
+        else:
+            requests = len(await main.plan_audio_chunks(prepared))
+        started = time.monotonic()
+        text = await main.transcribe_prepared(prepared)
+        elapsed = time.monotonic() - started
+    finally:
+        if not prepared.in_memory and os.path.exists(prepared.path):
+            os.remove(prepared.path)
+
+    reference_path = os.path.splitext(path)[0] + ".txt"
+    wer = None
+    if os.path.exists(reference_path):
+        with open(reference_path, encoding="utf-8") as f:
+            wer = word_error_rate(f.read(), text)
+    return {
+        "duration": source.duration,
+        "size": prepared.size,
+        "requests": requests,
+        "seconds": elapsed,
+        "wer": wer,
+    }
+
+
+async def run(samples_dir: str, profiles: list):
+    files = sorted(
+        os.path.join(samples_dir, name) for name in os.listdir(samples_dir)
+        if not name.endswith(".txt")
+    )
+    print(f"{'файл':30} {'профиль':10} {'мин':>6} {'МБ':>6} {'запросов':>8} {'сек':>7} {'WER':>6}")
+    totals = {profile.name: [0, 0.0, []] for profile in profiles}
+    for path in files:
+        for profile in profiles:
+            result = await bench_file(path, profile)
+            total = totals[profile.name]
+            total[0] += result["requests"]
+            total[1] += result["seconds"]
+            if result["wer"] is not None:
+                total[2].append(result["wer"])
+            wer = f"{result['wer']:.3f}" if result["wer"] is not None else "-"
+            print(
+                f"{os.path.basename(path)[:30]:30} {profile.name:10} {result['duration'] / 60:6.1f} "
+                f"{result['size'] / 1024 / 1024:6.1f} {result['requests']:8} {result['seconds']:7.1f} {wer:>6}"
+            )
+    print()
+    for name, (requests, seconds, wers) in totals.items():
+        mean_wer = f"{sum(wers) / len(wers):.3f}" if wers else "-"
+        print(f"{name:10} запросов {requests:5}  время {seconds:8.1f} сек  средний WER {mean_wer}")
+    auto = [main.choose_encoding_profile((await main.probe_media(path)).duration).name for path in files]
+    print(f"Автовыбор профилей: {', '.join(auto)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("samples", help="папка с аудио и эталонными .txt")
+    parser.add_argument("--profiles", default=main.ENCODING_PROFILES_SPEC, help="профили вида mp3:64,opus:24")
+    args = parser.parse_args()
+    asyncio.run(run(args.samples, main.parse_encoding_profiles(args.profiles)))
@@ -0,0 +1,382 @@
+"""Офлайн-бенчмарк всего конвейера на локальных заглушках Telegram, Drive, OpenAI и Sheets.
+
+Запуск (нужен только ffmpeg, сеть и ключи не нужны):
+    python benchmarks/pipeline.py --voice 20 --links 5 --folder 30 --users 4 \
+        --whisper-latency 2 --assistant-latency 5 --fail-rate 0.05
+
+Настоящие обработчики (handle_tg_audio, handle_audio_link с файлом и с папкой)
+получают сгенерированные сообщения. Bot API, Drive (files.list, get, alt=media,
+токен сервисного аккаунта) и OpenAI (транскрибация, Assistants, chat) отвечают
+с локального aiohttp-сервера в отдельном потоке, чтобы он не влиял на задержки
+event loop бота. Sheets подменяется на уровне SheetsWriter._append_rows, потому
+что адрес API у gspread не настраивается.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import rsa
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeServices:
+    """Заглушки внешних сервисов с настраиваемой задержкой и долей отказов"""
+
+    def __init__(self, whisper_latency: float, assistant_latency: float, fail_rate: float):
+        self.whisper_latency = whisper_latency
+        self.assistant_latency = assistant_latency
+        self.fail_rate = fail_rate
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.files = {}  # id -> (имя, байты)
+        self.folder = []  # id файлов в тестовой папке
+        self.runs = {}
+        self.counters = {"transcriptions": 0, "injected_failures": 0, "runs": 0, "sent_messages": 0}
+        self.local_dir = None  # Режим локального telegram-bot-api: getFile отдает путь на диске
+        self._ready = threading.Event()
+
+    def add_file(self, name: str, data: bytes, in_folder: bool = False) -> str:
+        file_id = uuid.uuid4().hex
+        self.files[file_id] = (name, data)
+        if in_folder:
+            self.folder.append(file_id)
+        return file_id
+
+    def metadata(self, file_id: str) -> dict:
+        name, data = self.files[file_id]
+        return {
+            "id": file_id,
+            "name": name,
+            "mimeType": "audio/mpeg",
+            "size": str(len(data)),
+            "md5Checksum": hashlib.md5(data).hexdigest(),
+            "modifiedTime": "2024-01-01T00:00:00.000Z",
+        }
+
+    # Telegram Bot API
+    async def telegram_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        if method.lower() == "getfile":
+            name, data = self.files[params["file_id"]]
+            file_path = f"music/{params['file_id']}"
+            if self.local_dir:
+                file_path = os.path.join(self.local_dir, params["file_id"])
+                if not os.path.exists(file_path):
+                    with open(file_path, "wb") as f:
+                        f.write(data)
+            return web.json_response({"ok": True, "result": {
+                "file_id": params["file_id"], "file_unique_id": params["file_id"][:16],
+                "file_size": len(data), "file_path": file_path,
+            }})
+        self.counters["sent_messages"] += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": random.randint(1, 10 ** 9), "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "text": params.get("text", ""),
+        }})
+
+    async def telegram_file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].split("/")[-1]
+        return web.Response(body=self.files[file_id][1])
+
+    # Google Drive и OAuth
+    async def token(self, request: web.Request) -> web.Response:
+        return web.json_response({"access_token": "bench", "expires_in": 3600, "token_type": "Bearer"})
+
+    async def drive_list(self, request: web.Request) -> web.Response:
+        files = [self.metadata(file_id) for file_id in self.folder] if "'benchfolder' in parents" in request.query.get("q", "") else []
+        return web.json_response({"files": files})
+
+    async def drive_get(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["file_id"]
+        if request.query.get("alt") != "media":
+            return web.json_response(self.metadata(file_id))
+        data = self.files[file_id][1]
+        if request.http_range.start is not None or request.http_range.stop is not None:
+            part = data[request.http_range]
+            start = request.http_range.start or 0
+            return web.Response(status=206, body=part, headers={
+                "Content-Range": f"bytes {start}-{start + len(part) - 1}/{len(data)}"
+            })
+        return web.Response(body=data)
+
+    # OpenAI
+    async def transcription(self, request: web.Request) -> web.Response:
+        await request.read()
+        self.counters["transcriptions"] += 1
+        await asyncio.sleep(self.whisper_latency)
+        if random.random() < self.fail_rate:
+            self.counters["injected_failures"] += 1
+            return web.json_response({"error": {"message": "injected failure", "type": "server_error"}}, status=500)
+        return web.json_response({"text": "Здравствуйте, это синтетическая расшифровка звонка для бенчмарка."})
+
+    async def chat_completion(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Empty/Empty/Empty/Empty"}}],
+        })
+
+    async def create_thread(self, request: web.Request) -> web.Response:
+        return web.json_response({"id": f"thread_{uuid.uuid4().hex}", "object": "thread", "created_at": 0, "metadata": {}})
+
+    def _message(self, thread_id: str, role: str, text: str) -> dict:
+        return {
+            "id": f"msg_{uuid.uuid4().hex}", "object": "thread.message", "created_at": 0,
+            "thread_id": thread_id, "role": role, "status": "completed", "attachments": [], "metadata": {},
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+        }
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        return web.json_response(self._message(request.match_info["thread_id"], "user", ""))
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        message = self._message(request.match_info["thread_id"], "assistant", "Оценка звонка: 8/10")
+        return web.json_response({"object": "list", "data": [message], "has_more": False, "first_id": message["id"], "last_id": message["id"]})
+
+    def _run(self, thread_id: str, run_id: str, status: str) -> dict:
+        return {
+            "id": run_id, "object": "thread.run", "created_at": 0, "thread_id": thread_id,
+            "assistant_id": "asst_bench", "status": status, "model": "gpt-4o", "instructions": "",
+            "tools": [], "metadata": {}, "parallel_tool_calls": True,
+        }
+
+    async def create_run(self, request: web.Request) -> web.Response:
+        run_id = f"run_{uuid.uuid4().hex}"
+        self.runs[run_id] = time.monotonic()
+        self.counters["runs"] += 1
+        return web.json_response(self._run(request.match_info["thread_id"], run_id, "queued"))
+
+    async def get_run(self, request: web.Request) -> web.Response:
+        run_id = request.match_info["run_id"]
+        done = time.monotonic() - self.runs[run_id] >= self.assistant_latency
+        return web.json_response(self._run(request.match_info["thread_id"], run_id, "completed" if done else "in_progress"))
+
+    async def cancel_run(self, request: web.Request) -> web.Response:
+        return web.json_response(self._run(request.match_info["thread_id"], request.match_info["run_id"], "cancelled"))
+
+    def _app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self.telegram_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.telegram_file)
+        app.router.add_post("/token", self.token)
+        app.router.add_get("/drive/v3/files", self.drive_list)
+        app.router.add_get("/drive/v3/files/{file_id}", self.drive_get)
+        app.router.add_post("/v1/audio/transcriptions", self.transcription)
+        app.router.add_post("/v1/chat/completions", self.chat_completion)
+        app.router.add_post("/v1/threads", self.create_thread)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self.create_message)
+        app.router.add_get("/v1/threads/{thread_id}/messages", self.list_messages)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self.create_run)
+        app.router.add_get("/v1/threads/{thread_id}/runs/{run_id}", self.get_run)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run)
+        return app
+
+    def _serve(self):
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(self._app(), access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", self.port).start())
+        self._ready.set()
+        loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        self._ready.wait()
+
+
+def make_fixture(duration: int, directory: str) -> bytes:
+    """Синтетическая «речь»: тон 6 сек, пауза 2 сек, чтобы было где резать на чанки"""
+    path = os.path.join(directory, f"fixture_{duration}.mp3")
+    if not os.path.exists(path):
+        subprocess.run([
+            "ffmpeg", "-nostdin", "-y", "-v", "error",
+            "-f", "lavfi", "-i", f"sine=frequency=300:duration={duration}",
+            "-af", "volume='if(lt(mod(t,8),6),1,0)':eval=frame",
+            "-ac", "1", "-b:a", "64k", path
+        ], check=True)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def configure_environment(services: FakeServices, work_dir: str):
+    """Направляет все клиенты main.py на заглушки; вызывается до импорта main"""
+    private_key = rsa.newkeys(2048)[1].save_pkcs1().decode()
+    os.environ.update({
+        "BOT_TOKEN": "123456:benchmark",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"{services.base_url}/v1",
+        "GS_TYPE": "service_account",
+        "GS_PROJECT_ID": "bench",
+        "GS_PRIVATE_KEY_ID": "bench",
+        "GS_PRIVATE_KEY": private_key,
+        "GS_CLIENT_EMAIL": "bench@bench.iam.gserviceaccount.com",
+        "GS_CLIENT_ID": "1",
+        "GS_TOKEN_URI": f"{services.base_url}/token",
+        "DRIVE_API_ENDPOINT": services.base_url,
+        "GSHEETS_SPREADSHEET_ID": "bench",
+        "JOBS_DIR": work_dir,
+    })
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run_benchmark(args, services: FakeServices, fixtures: list):
+    import main
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.types import Message
+
+    main.bot.session.api = TelegramAPIServer.from_base(services.base_url, is_local=bool(services.local_dir))
+    rows = []
+
+    def fake_append_rows(key: tuple, batch: list) -> int:
+        time.sleep(args.sheets_latency)
+        first = len(rows) + 2
+        rows.extend(batch)
+        return first
+
+    main.sheets_writer._append_rows = fake_append_rows
+    if not args.cache:
+        # Фикстуры повторяются, и кэш расшифровок отдал бы их без Whisper
+        # Кэш нулевого объема: поиск идет как обычно, а записи сразу вытесняются
+        main.transcript_cache = main.ThreadedStore(main.TranscriptCache(os.path.join(main.JOBS_DIR, "bench_transcripts.db"), max_bytes=0))
+
+    loop = asyncio.get_running_loop()
+    lag = []
+
+    async def monitor_lag(interval: float = 0.05):
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag.append(loop.time() - started - interval)
+
+    async def user_state(user_id: int) -> FSMContext:
+        state = FSMContext(storage=main.storage, key=StorageKey(bot_id=main.bot.id, chat_id=user_id, user_id=user_id))
+        await state.update_data(ass_token="asst_bench", company_name="Бенчмарк")
+        await state.set_state(main.UserState.audio)
+        return state
+
+    def message(user_id: int, **payload) -> Message:
+        return Message.model_validate({
+            "message_id": random.randint(1, 10 ** 9),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"},
+            **payload,
+        }, context={"bot": main.bot})
+
+    latencies = {"voice": [], "link": []}
+
+    async def timed(kind: str, coro):
+        started = time.monotonic()
+        await coro
+        latencies[kind].append(time.monotonic() - started)
+
+    requests = []
+    for i in range(args.voice):
+        user_id = 1000 + i % args.users
+        name, data, duration = random.choice(fixtures)
+        file_id = services.add_file(name, data)
+        msg = message(user_id, audio={
+            "file_id": file_id, "file_unique_id": file_id[:16], "duration": duration,
+            "file_size": len(data), "file_name": name, "mime_type": "audio/mpeg",
+        })
+        requests.append(timed("voice", main.handle_tg_audio(msg, await user_state(user_id))))
+    for i in range(args.links):
+        user_id = 2000 + i % args.users
+        name, data, _ = random.choice(fixtures)
+        file_id = services.add_file(name, data)
+        msg = message(user_id, text=f"https://drive.google.com/file/d/{file_id}/view")
+        requests.append(timed("link", main.handle_audio_link(msg, await user_state(user_id))))
+    folder_time = []
+    if args.folder:
+        for i in range(args.folder):
+            name, data, _ = random.choice(fixtures)
+            services.add_file(f"{i}_{name}", data, in_folder=True)
+
+        async def folder_job():
+            started = time.monotonic()
+            msg = message(3000, text="https://drive.google.com/drive/folders/benchfolder")
+            await main.handle_audio_link(msg, await user_state(3000))
+            folder_time.append(time.monotonic() - started)
+
+        requests.append(folder_job())
+
+    monitor = asyncio.create_task(monitor_lag())
+    started = time.monotonic()
+    await asyncio.gather(*requests)
+    elapsed = time.monotonic() - started
+    monitor.cancel()
+    await main.drive_downloader.close()
+
+    own_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"Обработано файлов: {len(rows)} за {elapsed:.1f} сек, {len(rows) / elapsed * 60:.1f} файлов/мин")
+    for kind, values in latencies.items():
+        if values:
+            print(f"{kind:6} задержка p50 {percentile(values, 0.5):.2f} сек, p95 {percentile(values, 0.95):.2f} сек ({len(values)} шт.)")
+    if folder_time:
+        print(f"Папка из {args.folder} файлов: {folder_time[0]:.1f} сек")
+    print(f"Пиковый RSS: бот {own_rss:.0f} МБ, ffmpeg {children_rss:.0f} МБ")
+    print(f"Задержка event loop: p95 {percentile(lag, 0.95) * 1000:.1f} мс, максимум {max(lag, default=0) * 1000:.1f} мс")
+    print(f"Заглушки: {json.dumps(services.counters, ensure_ascii=False)}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", type=int, default=10, help="файлов, присланных в Telegram")
+    parser.add_argument("--links", type=int, default=5, help="ссылок на файлы Drive")
+    parser.add_argument("--folder", type=int, default=20, help="файлов в папке Drive (0 - без папки)")
+    parser.add_argument("--users", type=int, default=3, help="разных пользователей")
+    parser.add_argument("--durations", default="15,120,900", help="длительности синтетических записей, сек")
+    parser.add_argument("--whisper-latency", type=float, default=1.0)
+    parser.add_argument("--assistant-latency", type=float, default=3.0)
+    parser.add_argument("--sheets-latency", type=float, default=0.3)
+    parser.add_argument("--local-bot-api", action="store_true", help="имитировать telegram-bot-api --local (файлы читаются с диска)")
+    parser.add_argument("--cache", action="store_true", help="не отключать кэш расшифровок")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля отказов Whisper (HTTP 500)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="transcribator_bench_")
+    fixture_dir = os.path.join(tempfile.gettempdir(), "transcribator_bench_fixtures")
+    os.makedirs(fixture_dir, exist_ok=True)
+    durations = [int(d) for d in args.durations.split(",")]
+    fixtures = [(f"call_{d}s.mp3", make_fixture(d, fixture_dir), d) for d in durations]
+
+    services = FakeServices(args.whisper_latency, args.assistant_latency, args.fail_rate)
+    if args.local_bot_api:
+        services.local_dir = os.path.join(work_dir, "bot-api")
+        os.makedirs(services.local_dir)
+    services.start()
+    configure_environment(services, work_dir)
+    asyncio.run(run_benchmark(args, services, fixtures))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,21 +3,34 @@ import logging
 import sys
 import os
 import json
-from datetime import datetime, timedelta
+import hashlib
+import csv
+import sqlite3
+import re
+import threading
+import socket
+import contextvars
+from contextlib import asynccontextmanager
+import heapq
+import itertools
+from datetime import datetime, timedelta, timezone
 import aiohttp
+from aiohttp import web
 from aiogram import types
 from aiogram import Bot, Dispatcher, html, Router, BaseMiddleware, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.filters.state import StateFilter
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.exceptions import TelegramBadRequest
-from openai import OpenAI, AsyncOpenAI
-from pydub import AudioSegment  
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.types import Message, BufferedInputFile, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from openai import AsyncOpenAI
+import openai
 import tempfile
 import aiofiles
 import gspread
@@ -25,29 +38,133 @@ from oauth2client.service_account import ServiceAccountCredentials
 import uuid
 import math
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, SimpleFilesPathWrapper
 from urllib.parse import urlparse, parse_qs
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+import requests
+from google.auth.transport.requests import Request as GoogleAuthRequest
 import io
-from typing import List
+from typing import List, Tuple, Optional, AsyncIterator, Union, BinaryIO, Callable, Awaitable
+from collections import OrderedDict, deque
+from dataclasses import dataclass, asdict, astuple
 import time
+import random
+import email.utils
 import ffmpeg
 from logging.handlers import TimedRotatingFileHandler
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pathlib import Path
 
 # Конфигурация
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-client2 = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Повторы делает общий ограничитель запросов (UpstreamLimiter), встроенные повторы SDK отключены
+client2 = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 MAX_FILE_SIZE = 20 * 1024 * 1024  
+MIN_AUDIO_DURATION = 3  # Минимальная длительность аудио, сек
+MAX_AUDIO_DURATION = float(os.getenv("MAX_AUDIO_HOURS", "6")) * 3600  # Длиннее не принимаем, сек
+MAX_SOURCE_SIZE = int(os.getenv("MAX_SOURCE_MB", "2000")) * 1024 * 1024  # Предел размера файла из Google Drive
+ADMISSION_PROBE_MIN_BYTES = int(os.getenv("ADMISSION_PROBE_MIN_MB", "5")) * 1024 * 1024  # Файлы меньше дешевле скачать, чем проверять заранее
+ADMISSION_PROBE_TIMEOUT = 30  # Таймаут ffprobe по заголовку удаленного файла, сек
 CHUNK_DURATION = 120 
 DOWNLOAD_TIMEOUT = 600 
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024  # Размер блока записи на диск при скачивании
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Свой telegram-bot-api, например http://bot-api:8081; пусто - облачный API
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "1") == "1"  # Сервер запущен с --local: файлы до 2 ГБ лежат на его диске
+TELEGRAM_FILES_SERVER_DIR = os.getenv("TELEGRAM_FILES_SERVER_DIR", "")  # Каталог файлов у сервера (--dir), если у бота он смонтирован по другому пути
+TELEGRAM_FILES_LOCAL_DIR = os.getenv("TELEGRAM_FILES_LOCAL_DIR", "")  # Тот же каталог, как его видит бот
+TELEGRAM_FILE_LIMIT = (2000 if TELEGRAM_API_URL and TELEGRAM_API_LOCAL else 20) * 1024 * 1024  # Сколько Bot API разрешает скачать
+DRIVE_RANGE_PART_SIZE = int(os.getenv("DRIVE_RANGE_PART_SIZE_MB", "32")) * 1024 * 1024  # Размер диапазона при параллельном скачивании
+DRIVE_RANGE_PARTS = int(os.getenv("DRIVE_RANGE_PARTS", "4"))  # Одновременных диапазонов на один файл
 MAX_RETRIES = 10  
+STREAM_SPILL_BYTES = int(os.getenv("STREAM_SPILL_MB", "50")) * 1024 * 1024  # Файлы до этого размера обрабатываются в памяти, крупнее - через диск
 MAX_FILES_PER_FOLDER = 1000  # Максимальное количество файлов для обработки из одной папки
+FOLDER_LIST_CONCURRENCY = int(os.getenv("FOLDER_LIST_CONCURRENCY", "4"))  # Одновременно читаемых подпапок
+DRIVE_FOLDER_MIME = "application/vnd.google-apps.folder"
+DRIVE_API_ENDPOINT = os.getenv("DRIVE_API_ENDPOINT", "https://www.googleapis.com")  # Подменяется для прокси и локальных заглушек
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "1"))  # Окно накопления строк перед записью, сек
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", "50"))  # Максимум строк в одном append_rows
+FILENAME_CACHE_SIZE = int(os.getenv("FILENAME_CACHE_SIZE", "1024"))  # Сколько форм имен файлов помнить
+FILENAME_PATTERNS_PATH = os.getenv("FILENAME_PATTERNS_PATH")  # JSON-файл для сохранения выученных шаблонов
+JOBS_DIR = os.getenv("JOBS_DIR", "data")  # База заданий и скачанные файлы незавершенных заданий
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.getenv("TRANSCRIPT_CACHE_MAX_MB", "200")) * 1024 * 1024
+TRANSCRIPT_CACHE_TTL = float(os.getenv("TRANSCRIPT_CACHE_TTL_DAYS", "0")) * 86400  # 0 - без срока хранения
+TRANSCRIPTION_TIMEOUT = int(os.getenv("TRANSCRIPTION_TIMEOUT", "600"))  # Таймаут одного запроса к Whisper, сек
+ASSISTANT_TIMEOUT = int(os.getenv("ASSISTANT_TIMEOUT", "600"))  # Таймаут анализа ассистентом, сек
+CHUNK_CONCURRENCY = int(os.getenv("CHUNK_CONCURRENCY", "4"))  # Параллельных чанков на один файл
+TRANSCRIPTION_CONCURRENCY = int(os.getenv("TRANSCRIPTION_CONCURRENCY", "16"))  # Одновременных запросов к Whisper на весь процесс
+CHUNK_OVERLAP = float(os.getenv("CHUNK_OVERLAP", "2"))  # Перекрытие соседних чанков, сек
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))  # Не чаще одного редактирования статуса папки, сек (лимит Telegram ~20 в минуту на чат)
+PROGRESS_RECENT_FILES = 5  # Сколько последних результатов показывать в статусе
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))  # Сколько ждать следующую часть альбома, сек
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "10"))  # Одновременно выполняемых задач на весь процесс
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))  # Одновременных скачиваний
+MEDIA_TOOL_TIMEOUT = int(os.getenv("MEDIA_TOOL_TIMEOUT", "900"))  # Таймаут одного запуска ffmpeg/ffprobe, сек
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))  # Одновременных запросов к ассистенту и gpt-4o
+RUN_POLL_CONCURRENCY = int(os.getenv("RUN_POLL_CONCURRENCY", "5"))  # Одновременных опросов статуса run на весь процесс
+RUN_POLL_MIN_INTERVAL = 1.0
+RUN_POLL_MAX_INTERVAL = 10.0
+WHISPER_RPM = float(os.getenv("WHISPER_RPM", "50"))  # Запросов к Whisper в минуту, 0 - без ограничения
+WHISPER_AUDIO_MINUTES = float(os.getenv("WHISPER_AUDIO_MINUTES", "0"))  # Минут аудио в минуту для Whisper, 0 - без ограничения
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))  # Запросов к ассистентам и gpt-4o в минуту
+DRIVE_RPM = float(os.getenv("DRIVE_RPM", "600"))  # Запросов к Google Drive в минуту
+SHEETS_RPM = float(os.getenv("SHEETS_RPM", "60"))  # Запросов на запись в Google Sheets в минуту
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "6"))  # Попыток одного запроса к внешнему сервису
+BACKOFF_BASE = 1.0  # Первая пауза перед повтором, сек; дальше удваивается
+BACKOFF_MAX = 60.0
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))  # Отказов подряд, после которых сервис считается недоступным
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))  # Пауза перед пробным запросом, сек; удваивается при неудаче
+BREAKER_MAX_COOLDOWN = 600.0
+SILENCE_NOISE = os.getenv("SILENCE_NOISE", "-35dB")
+SILENCE_MIN_DURATION = float(os.getenv("SILENCE_MIN_DURATION", "0.5"))
+ENCODING_PROFILES_SPEC = os.getenv("ENCODING_PROFILES", "mp3:64,mp3:32,opus:24")  # Кодек:кбит/с по убыванию качества
+UPLOAD_SIZE_MARGIN = 0.9  # Доля лимита Whisper, которую планируем занять (запас на VBR и заголовки)
+VAD_ENABLED = os.getenv("VAD_ENABLED", "0") == "1"  # Вырезать паузы перед транскрибацией
+VAD_NOISE = os.getenv("VAD_NOISE", "-40dB")
+VAD_MIN_SILENCE = float(os.getenv("VAD_MIN_SILENCE", "2"))  # Паузы короче не трогаем, сек
+VAD_KEEP_SILENCE = float(os.getenv("VAD_KEEP_SILENCE", "0.6"))  # Сколько тишины оставить на месте паузы, сек
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес сервиса, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Порт /metrics в режиме polling и у воркеров, 0 - не запускать
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")  # memory, sqlite или redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "all")  # all - все в одном процессе, bot - только Telegram, worker - только обработка
+WORK_QUEUE = os.getenv("WORK_QUEUE", "sqlite")  # Общая очередь задач между bot и worker: sqlite или redis
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", os.path.join(JOBS_DIR, "queue.db"))  # Для sqlite: файл на общем томе
+WORKER_ID = os.getenv("WORKER_ID", socket.gethostname())
+WORKER_LEASE = float(os.getenv("WORKER_LEASE", "120"))  # Сколько задание или задача очереди числятся за воркером без продления, потом их может взять другой, сек
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))  # Сколько раз воркеры берутся за задачу, которая падает с ошибкой; после последней ошибка уходит пользователю
+WATCH_DB_PATH = os.getenv("WATCH_DB_PATH", os.path.join(JOBS_DIR, "watch.db"))  # Отслеживаемые папки и уже обработанные в них файлы; читают и пишут только воркеры, если их несколько - файл на общем томе
+WATCH_INTERVAL = float(os.getenv("WATCH_INTERVAL_MIN", "60")) * 60  # Период проверки отслеживаемой папки, сек
+WATCH_TICK = 30  # Как часто искать папки, которым пора синхронизироваться, сек
+WATCH_CLOCK_SKEW = 300  # Запас к времени прошлой проверки, чтобы не потерять файлы на границе, сек
 IMG = "AgACAgIAAxkBAAO4aD2DBZsntEbv4pCVKjSi-Rg8JUkAAvPzMRuH3OlJMKrGXBeky5IBAAMCAAN4AAM2BA"
 
 
+def container_cpu_count() -> int:
+    """Число ядер, доступных процессу с учетом квоты cgroup (os.cpu_count видит все ядра хоста)"""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            count = min(count, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+TRANSCODE_CONCURRENCY = int(os.getenv("TRANSCODE_CONCURRENCY", str(container_cpu_count())))  # Одновременных запусков ffmpeg
+
+
 # Настройки Google Drive
 GOOGLE_DRIVE_CREDS = {
     "type": os.getenv("GS_TYPE"),
@@ -87,15 +204,83 @@ logging.basicConfig(
 
 logger = logging.getLogger("transcribator_bot")
 
+# Хранилища состояний FSM
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite: шаги диалога и данные пользователя переживают перезапуск"""
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            )
+        """)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in astuple(key))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        self._db.execute(
+            "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (self._key(key), value)
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = self._db.execute("SELECT state FROM fsm WHERE key = ?", (self._key(key),)).fetchone()
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        self._db.execute(
+            "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (self._key(key), json.dumps(dict(data), ensure_ascii=False))
+        )
+
+    async def get_data(self, key: StorageKey) -> dict:
+        row = self._db.execute("SELECT data FROM fsm WHERE key = ?", (self._key(key),)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    async def close(self) -> None:
+        self._db.close()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Хранилище FSM по FSM_STORAGE: memory, sqlite или redis"""
+    if FSM_STORAGE == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL)
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage(os.path.join(JOBS_DIR, "fsm.db"))
+    return MemoryStorage()
+
+
 # Инициализация бота
-session = AiohttpSession(timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT))
+def create_bot_session() -> AiohttpSession:
+    """Сессия Bot API: облачный сервер или свой telegram-bot-api (бот должен быть выведен из облака через logOut)"""
+    if not TELEGRAM_API_URL:
+        return AiohttpSession(timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT))
+    wrapper = None
+    if TELEGRAM_FILES_SERVER_DIR and TELEGRAM_FILES_LOCAL_DIR:
+        wrapper = SimpleFilesPathWrapper(Path(TELEGRAM_FILES_SERVER_DIR), Path(TELEGRAM_FILES_LOCAL_DIR))
+    api = TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL, **({"wrap_local_file": wrapper} if wrapper else {}))
+    return AiohttpSession(api=api, timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT))
+
+
+session = create_bot_session()
 bot = Bot(
     token=BOT_TOKEN,
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     timeout=300,
     session_timeout=DOWNLOAD_TIMEOUT  
 )
-storage = MemoryStorage()
+storage = create_fsm_storage()
+run_poll_limit = asyncio.Semaphore(RUN_POLL_CONCURRENCY)
 router = Router()
 dp = Dispatcher(storage=storage)
 
@@ -118,30 +303,515 @@ class StateMiddleware(BaseMiddleware):
         data['current_state'] = current_state
         return await handler(event, data)
 
+
+class AlbumMiddleware(BaseMiddleware):
+    """Собирает сообщения одной медиагруппы: обработчик вызывается один раз, весь альбом - в data['album']"""
+
+    def __init__(self, window: float = ALBUM_WINDOW):
+        self.window = window
+        self._albums = {}
+
+    async def __call__(self, handler, event: Message, data: dict):
+        if not event.media_group_id:
+            return await handler(event, data)
+        key = (event.chat.id, event.media_group_id)
+        if key in self._albums:
+            self._albums[key].append(event)
+            return
+        album = self._albums[key] = [event]
+        # Части альбома приходят отдельными апдейтами подряд; ждем, пока новые перестанут появляться
+        size = 0
+        while size != len(album):
+            size = len(album)
+            await asyncio.sleep(self.window)
+        del self._albums[key]
+        data['album'] = sorted(album, key=lambda m: m.message_id)
+        return await handler(event, data)
+
 # Сервис для работы с Google Drive
+_drive_credentials = None
+
+def get_drive_credentials():
+    """Общие для всего процесса учетные данные сервисного аккаунта Google Drive"""
+    global _drive_credentials
+    if _drive_credentials is None:
+        _drive_credentials = service_account.Credentials.from_service_account_info(
+            GOOGLE_DRIVE_CREDS,
+            scopes=['https://www.googleapis.com/auth/drive.readonly']
+        )
+    return _drive_credentials
+
 async def get_google_drive_service():
-    """Создает сервис для работы с Google Drive"""
-    creds = service_account.Credentials.from_service_account_info(
-        GOOGLE_DRIVE_CREDS,
-        scopes=['https://www.googleapis.com/auth/drive.readonly']
+    """Создает сервис для работы с Google Drive на общих учетных данных"""
+    logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+
+    return build(
+        'drive', 'v3',
+        credentials=get_drive_credentials(),
+        cache_discovery=False,
+        client_options={"api_endpoint": f"{DRIVE_API_ENDPOINT}/drive/v3/"}
     )
 
-    logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+# Метрики этапов и трассировка задач
+job_trace_id = contextvars.ContextVar("job_trace_id", default="-")
+trace_logger = logging.getLogger("transcribator_bot.trace")
+
+STAGE_SECONDS = Histogram(
+    "transcribator_stage_seconds", "Длительность этапа обработки", ["stage"],
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+STAGE_IN_FLIGHT = Gauge("transcribator_stage_in_flight", "Выполняющихся сейчас этапов", ["stage"])
+STAGE_FAILURES = Counter("transcribator_stage_failures_total", "Этапов, завершившихся ошибкой", ["stage"])
+BYTES_PROCESSED = Counter("transcribator_downloaded_bytes_total", "Скачано байт", ["source"])
+AUDIO_SECONDS = Counter("transcribator_audio_seconds_total", "Секунд аудио, отправленных на транскрибацию")
+TRANSCRIPT_CACHE_HITS = Counter("transcribator_transcript_cache_hits_total", "Файлов, транскрипция которых нашлась в кэше")
+TRANSCRIPT_CACHE_MISSES = Counter("transcribator_transcript_cache_misses_total", "Файлов, которых не оказалось в кэше транскрипций")
+QUEUE_DEPTH = Gauge("transcribator_queue_depth", "Задач, ожидающих в планировщике")
+
+
+@asynccontextmanager
+async def track_stage(stage: str, **fields):
+    """Замеряет этап: гистограмма, счетчик выполняющихся и строка трассировки с id задачи"""
+    STAGE_IN_FLIGHT.labels(stage).inc()
+    started = time.monotonic()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        STAGE_FAILURES.labels(stage).inc()
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        STAGE_IN_FLIGHT.labels(stage).dec()
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        trace_logger.info(json.dumps(
+            {"job": job_trace_id.get(), "stage": stage, "status": status, "seconds": round(elapsed, 3), **fields},
+            ensure_ascii=False
+        ))
+
+
+# Общий планировщик работ
+class JobScheduler:
+    """Единая очередь работ для всех входов (файлы Telegram, ссылки и папки Drive).
+
+    Очередь взвешенно-справедливая: у каждого пользователя свое виртуальное время,
+    поэтому папка на тысячу файлов не задерживает одиночные голосовые других людей.
+    Этапы (скачивание, перекодирование, транскрибация, LLM) ограничены отдельно.
+    """
+
+    def __init__(self, workers: int = SCHEDULER_WORKERS, stage_limits: Optional[dict] = None):
+        self.workers = workers
+        self._stages = {name: asyncio.Semaphore(limit) for name, limit in (stage_limits or {}).items()}
+        self._heap = []
+        self._counter = itertools.count()
+        self._vtime = 0.0
+        self._user_tags = {}
+        self._available = asyncio.Semaphore(0)
+        self._tasks = []
+        self._paused_until = 0.0
+
+    def stage(self, name: str) -> asyncio.Semaphore:
+        """Глобальный лимит этапа обработки"""
+        return self._stages[name]
+
+    @property
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def _ensure_workers(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, user_id: int, factory, weight: float = 1.0) -> asyncio.Future:
+        """Ставит работу пользователя в очередь; factory - функция, возвращающая корутину"""
+        self._ensure_workers()
+        tag = max(self._vtime, self._user_tags.get(user_id, 0.0)) + 1 / weight
+        self._user_tags[user_id] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (tag, next(self._counter), user_id, factory, future))
+        self._available.release()
+        return future
+
+    def pause(self, seconds: float):
+        """Не начинает новые задачи seconds секунд; начатые дорабатывают"""
+        self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + seconds)
+
+    def position(self, future: asyncio.Future) -> int:
+        """Сколько задач в очереди будут выполнены раньше этой"""
+        for entry in self._heap:
+            if entry[4] is future:
+                return sum(1 for other in self._heap if other[:2] < entry[:2])
+        return 0
+
+    async def run(self, user_id: int, factory, chat: Optional["ChatContext"] = None, weight: float = 1.0):
+        """Выполняет работу через очередь, при ожидании сообщает пользователю место в очереди"""
+        future = self.submit(user_id, factory, weight)
+        ahead = self.position(future)
+        if chat and ahead:
+            await chat.reply(f"⏳ Файл в очереди, перед ним задач: {ahead}")
+        return await future
+
+    async def _worker(self):
+        while True:
+            await self._available.acquire()
+            # Внешний сервис недоступен: задачи ждут в очереди, а не падают одна за другой
+            while (delay := self._paused_until - asyncio.get_running_loop().time()) > 0:
+                await asyncio.sleep(delay)
+            tag, _, user_id, factory, future = heapq.heappop(self._heap)
+            self._vtime = max(self._vtime, tag)
+            if self._user_tags.get(user_id) == tag:
+                # Больше задач этого пользователя в очереди нет
+                del self._user_tags[user_id]
+            if future.done():
+                continue
+            try:
+                result = await factory()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+
+scheduler = JobScheduler(stage_limits={
+    "download": DOWNLOAD_CONCURRENCY,
+    "transcode": TRANSCODE_CONCURRENCY,
+    "transcription": TRANSCRIPTION_CONCURRENCY,
+    "llm": LLM_CONCURRENCY,
+})
+QUEUE_DEPTH.set_function(lambda: scheduler.pending)
+
+
+# Ограничение частоты запросов к внешним сервисам
+UPSTREAM_RETRIES_TOTAL = Counter("transcribator_upstream_retries_total", "Повторов запросов к внешним сервисам", ["upstream", "reason"])
+UPSTREAM_CIRCUIT_OPEN = Gauge("transcribator_upstream_circuit_open", "Запросы к сервису приостановлены", ["upstream"])
+
+
+class RateLimited(Exception):
+    """Сервис ответил, что лимит запросов исчерпан"""
 
-    return build('drive', 'v3', credentials=creds)
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Пауза из заголовков Retry-After (секунды или дата) и retry-after-ms у OpenAI"""
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+def classify_upstream_error(e: Exception) -> Tuple[str, Optional[float]]:
+    """Вид ошибки внешнего сервиса: rate_limit, transient (можно повторить) или fatal, и пауза из ответа"""
+    if isinstance(e, RateLimited):
+        return "rate_limit", e.retry_after
+    if isinstance(e, openai.APIStatusError):
+        status, headers, text = e.status_code, e.response.headers, str(e.body or e.message)
+    elif isinstance(e, gspread.exceptions.APIError):
+        status, headers, text = e.response.status_code, e.response.headers, e.response.text
+    elif isinstance(e, HttpError):
+        status, headers, text = e.resp.status, e.resp, e.content.decode(errors="replace")
+    elif isinstance(e, aiohttp.ClientResponseError):
+        status, headers, text = e.status, e.headers, e.message
+    elif isinstance(e, (asyncio.TimeoutError, TimeoutError, openai.APIConnectionError, aiohttp.ClientError,
+                        requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return "transient", None
+    else:
+        return "fatal", None
+    retry_after = parse_retry_after(headers)
+    if status == 429 and "insufficient_quota" in text:
+        # Кончились деньги на счете, повтор не поможет
+        return "fatal", None
+    # Drive отвечает 403 rateLimitExceeded, Sheets - 429 "Quota exceeded"
+    if status == 429 or (status == 403 and any(reason in text for reason in ("rateLimitExceeded", "userRateLimitExceeded", "Quota exceeded"))):
+        return "rate_limit", retry_after
+    if status == 408 or status >= 500:
+        return "transient", retry_after
+    return "fatal", None
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    """Экспоненциальная пауза с полным джиттером, чтобы повторы разных задач не совпадали"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Ведро токенов: per_minute в минуту с запасом на короткий всплеск.
+
+    После 429 скорость снижается вдвое и затем плавно возвращается к заданной
+    по мере успешных запросов.
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.base_rate = per_minute / 60
+        self.rate = self.base_rate
+        self.capacity = burst or max(per_minute / 6, 1.0)
+        self._tokens = self.capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self._updated is None:
+            self._updated = now
+        self._tokens = min(self.capacity, self._tokens + max(now - self._updated, 0) * self.rate)
+        self._updated = max(self._updated, now)
+
+    async def acquire(self, amount: float = 1.0):
+        """Ждет, пока наберется amount токенов; больше запаса за раз не требуется, остаток уходит в долг"""
+        if self.base_rate <= 0:
+            return
+        # Lock держится на время ожидания, поэтому токены выдаются по очереди
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                self._refill(loop.time())
+                wait = (min(amount, self.capacity) - self._tokens) / self.rate
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._tokens -= amount
+
+    def pause(self, seconds: float):
+        """Сервис попросил подождать: токены не копятся seconds секунд, скорость снижается"""
+        if self.base_rate <= 0:
+            return
+        now = asyncio.get_running_loop().time()
+        self._refill(now)
+        self._tokens = min(self._tokens, 0.0)
+        self._updated = max(self._updated, now + seconds)
+        self.rate = max(self.rate / 2, self.base_rate / 10)
+
+    def recover(self):
+        self.rate = min(self.rate + self.base_rate / 20, self.base_rate)
+
+
+class CircuitBreaker:
+    """После threshold отказов подряд приостанавливает запросы к сервису и планировщик.
+
+    По истечении паузы пропускает один пробный запрос: успех закрывает цепь,
+    неудача открывает ее снова на вдвое больший срок. Ответы на запросы, начатые
+    до размыкания, пока цепь разомкнута, ее состояние не меняют.
+    """
+
+    PROBE_POLL_INTERVAL = 0.5
+
+    def __init__(self, name: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN, on_open=None):
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.on_open = on_open
+        self._failures = 0
+        self._open_until = 0.0
+        self._half_open = False
+        self._probing = False
+
+    async def admit(self) -> bool:
+        """Ждет, пока цепь закрыта или можно сделать пробный запрос; True - это пробный запрос"""
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = self._open_until - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if not self._half_open:
+                return False
+            if not self._probing:
+                self._probing = True
+                return True
+            await asyncio.sleep(self.PROBE_POLL_INTERVAL)
+
+    def end_probe(self):
+        self._probing = False
+
+    def record_success(self, probe: bool = False):
+        if self._half_open and not probe:
+            return
+        self._failures = 0
+        if probe:
+            self._half_open = False
+            self.cooldown = self.base_cooldown
+            UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(0)
+            logger.info(f"{self.name}: сервис снова отвечает, запросы возобновлены")
+
+    def record_failure(self, retry_after: Optional[float] = None, probe: bool = False):
+        if self._half_open and not probe:
+            return
+        self._failures += 1
+        if probe:
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+        elif self._failures < self.threshold:
+            return
+        duration = max(self.cooldown, retry_after or 0)
+        self._open_until = asyncio.get_running_loop().time() + duration
+        self._half_open = True
+        UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(1)
+        logger.warning(f"{self.name}: {self._failures} отказов подряд, запросы и новые задачи приостановлены на {duration:.0f} сек")
+        if self.on_open:
+            self.on_open(duration)
+
+
+class UpstreamLimiter:
+    """Общий для процесса лимит запросов к одному внешнему сервису с повторами и размыканием цепи"""
+
+    def __init__(self, name: str, requests_per_minute: float, units_per_minute: float = 0, retries: int = UPSTREAM_RETRIES):
+        self.name = name
+        self.retries = retries
+        self.requests = TokenBucket(requests_per_minute)
+        self.units = TokenBucket(units_per_minute, burst=units_per_minute) if units_per_minute else None
+        self.breaker = CircuitBreaker(name, on_open=scheduler.pause)
+
+    async def call(self, func, units: float = 0, idempotent: bool = True, retries: Optional[int] = None):
+        """Вызывает func() (функцию, возвращающую корутину) в пределах лимитов, повторяя временные отказы.
+
+        Неидемпотентные запросы повторяются только после явного отказа по лимиту,
+        когда сервис точно ничего не выполнил.
+        """
+        retries = retries or self.retries
+        for attempt in range(retries):
+            probe = await self.breaker.admit()
+            await self.requests.acquire()
+            if units and self.units:
+                await self.units.acquire(units)
+            try:
+                result = await func()
+            except Exception as e:
+                kind, retry_after = classify_upstream_error(e)
+                retryable = kind == "rate_limit" or (kind == "transient" and idempotent)
+                if kind != "fatal":
+                    self.breaker.record_failure(retry_after, probe)
+                if not retryable or attempt == retries - 1:
+                    raise
+                error = e
+            else:
+                self.breaker.record_success(probe)
+                self.requests.recover()
+                return result
+            finally:
+                if probe:
+                    self.breaker.end_probe()
+            UPSTREAM_RETRIES_TOTAL.labels(self.name, kind).inc()
+            if kind == "rate_limit":
+                self.requests.pause(retry_after or backoff_delay(attempt))
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            logger.warning(f"{self.name}: {error!r}, повтор {attempt + 2}/{retries} через {delay:.1f} сек")
+            await asyncio.sleep(delay)
+
+
+whisper_limiter = UpstreamLimiter("whisper", WHISPER_RPM, units_per_minute=WHISPER_AUDIO_MINUTES * 60)
+openai_limiter = UpstreamLimiter("openai", OPENAI_RPM)
+drive_limiter = UpstreamLimiter("drive", DRIVE_RPM)
+sheets_limiter = UpstreamLimiter("sheets", SHEETS_RPM)
 
 async def get_chatgpt_response(prompt: str) -> str:
     try:
-        response = await client2.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7  
-        )
+        async with scheduler.stage("llm"), track_stage("filename_llm"):
+            response = await openai_limiter.call(lambda: client2.chat.completions.create(
+                model="gpt-4o",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.7
+            ))
         return response.choices[0].message.content
     except Exception as e:
         logger.error(f"OpenAI error: {e}")
         return "Извините, не удалось обработать запрос"  
 
+# Асинхронный сервис для работы с OpenAI
+async def transcribe_audio(file_path: str, timeout: float = TRANSCRIPTION_TIMEOUT, data: Optional[bytes] = None, duration: float = 0) -> str:
+    """Транскрибирует аудиофайл (или буфер в памяти с именем file_path) через Whisper, не блокируя event loop.
+
+    duration (сек) расходует лимит минут аудио, таймаут действует на каждую попытку.
+    """
+    if data is None:
+        async with aiofiles.open(file_path, "rb") as f:
+            data = await f.read()
+    async with scheduler.stage("transcription"), track_stage("transcription", bytes=len(data)):
+        transcript = await whisper_limiter.call(lambda: asyncio.wait_for(
+            client2.audio.transcriptions.create(
+                file=(os.path.basename(file_path), data),
+                model="whisper-1",
+                language="ru"
+            ),
+            timeout=timeout
+        ), units=duration)
+    return transcript.text
+
+RUN_TERMINAL_FAILURES = ("failed", "cancelled", "cancelling", "expired", "incomplete", "requires_action")
+
+
+async def wait_for_run(thread_id: str, run_id: str, timeout: float = ASSISTANT_TIMEOUT):
+    """Дожидается завершения run с нарастающим интервалом опроса и жестким дедлайном"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    interval = RUN_POLL_MIN_INTERVAL
+    while True:
+        # Общий лимит на одновременные запросы статуса для всех run в процессе
+        async with run_poll_limit:
+            run = await openai_limiter.call(lambda: client2.beta.threads.runs.retrieve(
+                thread_id=thread_id,
+                run_id=run_id,
+                timeout=max(deadline - loop.time(), 1)
+            ))
+        if run.status == "completed":
+            return run
+        if run.status in RUN_TERMINAL_FAILURES:
+            error = getattr(run, "last_error", None)
+            raise RuntimeError(f"Ассистент завершился со статусом {run.status}" + (f": {error.message}" if error else ""))
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise TimeoutError(f"Ассистент не ответил за {timeout} сек (статус {run.status})")
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 1.5, RUN_POLL_MAX_INTERVAL)
+
+
+async def _run_assistant(thread_id: str, assistant_id: str, timeout: float) -> str:
+    """Запускает ассистента в треде, дожидается завершения и возвращает ответ"""
+    run = await openai_limiter.call(lambda: client2.beta.threads.runs.create(
+        thread_id=thread_id,
+        assistant_id=assistant_id
+    ), idempotent=False)
+    try:
+        await wait_for_run(thread_id, run.id, timeout)
+    except (asyncio.CancelledError, TimeoutError):
+        # Не оставляем run висеть на стороне OpenAI
+        try:
+            await asyncio.shield(client2.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id))
+        except Exception as e:
+            logger.warning(f"Не удалось отменить run {run.id}: {e}")
+        raise
+
+    messages = await openai_limiter.call(lambda: client2.beta.threads.messages.list(thread_id=thread_id, limit=1))
+    return messages.data[0].content[0].text.value
+
+async def analyze_transcription(transcription_text: str, assistant_id: str, timeout: float = ASSISTANT_TIMEOUT) -> str:
+    """Отправляет транскрипцию ассистенту и возвращает его ответ"""
+    async with scheduler.stage("llm"), track_stage("assistant"):
+        thread = await openai_limiter.call(client2.beta.threads.create)
+        await openai_limiter.call(lambda: client2.beta.threads.messages.create(
+            thread_id=thread.id,
+            role="user",
+            content=transcription_text
+        ), idempotent=False)
+        return await _run_assistant(thread.id, assistant_id, timeout)
+
 def extract_file_id_from_url(url: str) -> str:
     """Извлекает ID файла или папки из URL Google Drive с учетом всех форматов"""
     try:
@@ -183,340 +853,2248 @@ def extract_file_id_from_url(url: str) -> str:
         logger.error(f"Error extracting ID from URL: {e}")
         return None
 
-async def download_from_google_drive(file_id: str, destination: str) -> bool:
-    """Скачивает файл из Google Drive"""
+class DriveDownloader:
+    """Скачивание из Google Drive напрямую через alt=media с одной aiohttp-сессией.
+
+    Большие файлы качаются параллельными диапазонами байт, каждый диапазон
+    при обрыве докачивается с последнего записанного байта.
+    """
+
+    API_URL = f"{DRIVE_API_ENDPOINT}/drive/v3/files"
+
+    def __init__(self, part_size: int = DRIVE_RANGE_PART_SIZE, parallel_parts: int = DRIVE_RANGE_PARTS):
+        self.part_size = part_size
+        self.parallel_parts = parallel_parts
+        self._session = None
+        self._token_lock = asyncio.Lock()
+
+    async def _auth_headers(self) -> dict:
+        async with self._token_lock:
+            creds = get_drive_credentials()
+            if not creds.valid:
+                await asyncio.to_thread(creds.refresh, GoogleAuthRequest())
+        return {"Authorization": f"Bearer {creds.token}"}
+
+    @staticmethod
+    async def _check_status(resp: aiohttp.ClientResponse):
+        """Как raise_for_status, но с телом ответа: по нему отличаются 403 из-за лимита и из-за прав"""
+        if resp.status >= 400:
+            raise aiohttp.ClientResponseError(
+                resp.request_info, resp.history,
+                status=resp.status, message=await resp.text(), headers=resp.headers
+            )
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            )
+        return self._session
+
+    async def metadata(self, file_id: str, fields: str = "id, name, mimeType, size, md5Checksum, modifiedTime, videoMediaMetadata(durationMillis)") -> dict:
+        async def request():
+            async with self._get_session().get(
+                f"{self.API_URL}/{file_id}",
+                params={"fields": fields, "supportsAllDrives": "true"},
+                headers=await self._auth_headers()
+            ) as resp:
+                await self._check_status(resp)
+                return await resp.json()
+
+        return await drive_limiter.call(request)
+
+    async def _fetch_range(self, file_id: str, destination: Union[str, bytearray], start: int, end: Optional[int]):
+        """Качает байты [start, end] в файл или буфер по тому же смещению, докачивая при обрывах"""
+        position = start
+
+        async def attempt():
+            # Каждая попытка продолжает с последнего записанного байта
+            nonlocal position
+            headers = await self._auth_headers()
+            if position or end is not None:
+                headers["Range"] = f"bytes={position}-{'' if end is None else end}"
+            async with self._get_session().get(
+                f"{self.API_URL}/{file_id}",
+                params={"alt": "media", "supportsAllDrives": "true"},
+                headers=headers
+            ) as resp:
+                if resp.status == 401:
+                    get_drive_credentials().token = None
+                    raise aiohttp.ClientError("токен Google устарел")
+                await self._check_status(resp)
+                if "Range" in headers and resp.status != 206:
+                    raise RuntimeError(f"Drive не поддержал Range для {file_id} (HTTP {resp.status})")
+                if isinstance(destination, bytearray):
+                    async for block in resp.content.iter_chunked(DOWNLOAD_BUFFER_SIZE):
+                        destination[position:position + len(block)] = block
+                        position += len(block)
+                    return
+                async with aiofiles.open(destination, "r+b") as f:
+                    await f.seek(position)
+                    async for block in resp.content.iter_chunked(DOWNLOAD_BUFFER_SIZE):
+                        await f.write(block)
+                        position += len(block)
+
+        await drive_limiter.call(attempt, retries=MAX_RETRIES)
+
+    async def download(self, file_id: str, destination: Union[str, bytearray], size: Optional[int] = None):
+        """Скачивает файл по пути destination или в буфер bytearray"""
+        if size is None:
+            size = (await self.metadata(file_id, fields="size")).get("size")
+        size = int(size or 0)
+        # Создаем файл (буфер) заранее, чтобы диапазоны писали каждый в свое место
+        if isinstance(destination, bytearray):
+            destination[:] = bytes(size)
+        else:
+            async with aiofiles.open(destination, "wb") as f:
+                if size:
+                    await f.truncate(size)
+        if size < self.part_size * 2:
+            await self._fetch_range(file_id, destination, 0, None)
+            return
+        limit = asyncio.Semaphore(self.parallel_parts)
+
+        async def fetch_part(start: int):
+            async with limit:
+                await self._fetch_range(file_id, destination, start, min(start + self.part_size, size) - 1)
+
+        await asyncio.gather(*(fetch_part(start) for start in range(0, size, self.part_size)))
+
+    async def probe_duration(self, file_id: str) -> Optional[float]:
+        """Длительность по заголовку файла без скачивания: ffprobe сам читает нужные диапазоны байт"""
+        url = f"{self.API_URL}/{file_id}?alt=media&supportsAllDrives=true"
+        headers = await self._auth_headers()
+        return await drive_limiter.call(lambda: probe_remote_duration(url, headers))
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+drive_downloader = DriveDownloader()
+
+async def get_drive_file_metadata(file_id: str) -> dict:
+    """Возвращает метаданные файла из Google Drive без скачивания содержимого"""
+    return await drive_downloader.metadata(file_id)
+
+async def download_from_google_drive(file_id: str, destination: Union[str, bytearray], size: Optional[int] = None) -> bool:
+    """Скачивает файл из Google Drive на диск или в буфер в памяти"""
+    try:
+        async with scheduler.stage("download"), track_stage("download", source="drive"):
+            await drive_downloader.download(file_id, destination, size)
+        BYTES_PROCESSED.labels("drive").inc(len(destination) if isinstance(destination, bytearray) else os.path.getsize(destination))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка загрузки из Google Drive: {e}")
+        return False
+
+class FolderListingError(Exception):
+    """Часть папок не удалось прочитать; найденные в остальных файлы уже отданы"""
+
+
+async def iter_folder_files(folder_id: str, max_files: int = MAX_FILES_PER_FOLDER, concurrency: int = FOLDER_LIST_CONCURRENCY,
+                            modified_after: Optional[str] = None, skip: Optional[Callable[[dict], Awaitable[bool]]] = None) -> AsyncIterator[dict]:
+    """Обходит папку и вложенные папки постранично и отдает аудио и видео файлы по мере нахождения.
+
+    modified_after (RFC 3339, UTC) оставляет только файлы, созданные или измененные позже;
+    подпапки обходятся всегда, их modifiedTime не меняется при добавлении файлов.
+    Если какую-то папку прочитать не удалось, обход остальных продолжается,
+    а в конце поднимается FolderListingError.
+    skip (корутина) отсеивает уже обработанные файлы до лимита max_files; если после лимита
+    остались неотсеянные файлы, тоже поднимается FolderListingError.
+    """
+    media_filter = "(mimeType contains 'audio/' or mimeType contains 'video/' or mimeType contains 'application/octet-stream')"
+    if modified_after:
+        # createdTime ловит загруженные файлы, у которых modifiedTime сохранен с компьютера
+        media_filter = f"({media_filter} and (modifiedTime > '{modified_after}' or createdTime > '{modified_after}'))"
+    folders = asyncio.Queue()
+    found = asyncio.Queue()
+    folders.put_nowait(folder_id)
+    errors = []
+
+    async def worker(service):
+        while True:
+            current = await folders.get()
+            try:
+                page_token = None
+                while True:
+                    response = await drive_limiter.call(lambda: asyncio.to_thread(
+                        service.files().list(
+                            q=f"'{current}' in parents and trashed = false and (mimeType = '{DRIVE_FOLDER_MIME}' or {media_filter})",
+                            fields="nextPageToken, files(id, name, mimeType, size, md5Checksum, modifiedTime, videoMediaMetadata(durationMillis))",
+                            pageSize=1000,
+                            pageToken=page_token,
+                            supportsAllDrives=True,
+                            includeItemsFromAllDrives=True
+                        ).execute
+                    ))
+                    for item in response.get('files', []):
+                        if item['mimeType'] == DRIVE_FOLDER_MIME:
+                            folders.put_nowait(item['id'])
+                        else:
+                            found.put_nowait(item)
+                    page_token = response.get('nextPageToken')
+                    if not page_token:
+                        break
+            except Exception as e:
+                logger.error(f"Ошибка чтения папки {current} в Google Drive: {e}")
+                errors.append(e)
+            finally:
+                folders.task_done()
+
+    async def finish():
+        # Обходчики сами не завершаются; если какой-то упал, обход не закончится, поэтому ждем и их
+        joined = asyncio.create_task(folders.join())
+        done, _ = await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+        joined.cancel()
+        for task in done:
+            if task is not joined and not task.cancelled() and task.exception():
+                errors.append(task.exception())
+        found.put_nowait(None)
+
+    # У каждого обходчика свой сервис: http-клиент googleapiclient не потокобезопасен.
+    # Создаем их заранее, чтобы ошибка авторизации сразу дошла до вызывающего
+    services = [await get_google_drive_service() for _ in range(concurrency)]
+    workers = [asyncio.create_task(worker(service)) for service in services]
+    tasks = [*workers, asyncio.create_task(finish())]
+    try:
+        count = 0
+        while True:
+            item = await found.get()
+            if item is None:
+                if errors:
+                    raise FolderListingError(f"не удалось прочитать папок в Google Drive: {len(errors)} ({errors[0]})")
+                break
+            if skip and await skip(item):
+                continue
+            if count >= max_files:
+                raise FolderListingError(
+                    f"новых файлов больше {max_files}, обработаны первые {max_files}; отправьте ссылку еще раз, чтобы продолжить"
+                )
+            count += 1
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class TelegramDownloader:
+    """Файлы Telegram: с локального telegram-bot-api читаются на месте, из облака качаются потоком с докачкой"""
+
+    def __init__(self):
+        self._session = None
+
+    def local_path(self, file: types.File) -> Optional[str]:
+        """Путь к файлу на диске локального Bot API сервера, если бот его видит"""
+        api = bot.session.api
+        if not api.is_local or not file.file_path:
+            return None
+        path = str(api.wrap_local_file.to_local(file.file_path))
+        return path if os.path.isfile(path) else None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            )
+        return self._session
+
+    async def download(self, file: types.File, destination: Union[str, BinaryIO]) -> int:
+        """Качает файл блоками в путь или буфер; при обрыве продолжает с последнего записанного байта"""
+        url = bot.session.api.file_url(bot.token, file.file_path)
+        position = 0
+        for attempt in range(MAX_RETRIES):
+            headers = {"Range": f"bytes={position}-"} if position else {}
+            try:
+                async with scheduler.stage("download"), track_stage("download", source="telegram", attempt=attempt + 1):
+                    async with self._get_session().get(url, headers=headers) as resp:
+                        if 400 <= resp.status < 500:
+                            raise RuntimeError(f"Telegram не отдал файл (HTTP {resp.status})")
+                        resp.raise_for_status()
+                        if position and resp.status != 206:
+                            # Сервер не поддержал Range, начинаем сначала
+                            position = 0
+                        if isinstance(destination, str):
+                            async with aiofiles.open(destination, "r+b" if position else "wb") as f:
+                                await f.seek(position)
+                                await f.truncate()
+                                async for block in resp.content.iter_chunked(DOWNLOAD_BUFFER_SIZE):
+                                    await f.write(block)
+                                    position += len(block)
+                        else:
+                            destination.seek(position)
+                            destination.truncate()
+                            async for block in resp.content.iter_chunked(DOWNLOAD_BUFFER_SIZE):
+                                destination.write(block)
+                                position += len(block)
+                if file.file_size and position < file.file_size:
+                    raise aiohttp.ClientPayloadError(f"получено {position} из {file.file_size} байт")
+                return position
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                logger.warning(f"Обрыв скачивания {file.file_path} на байте {position}: {e}, докачиваю")
+                await asyncio.sleep(backoff_delay(attempt))
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+telegram_downloader = TelegramDownloader()
+
+
+async def safe_download_file(file: types.File, destination: Union[str, BinaryIO]) -> bool:
+    """Безопасное скачивание файла (на диск или в буфер) с докачкой при обрывах"""
+    size = await telegram_downloader.download(file, destination)
+    BYTES_PROCESSED.labels("telegram").inc(size)
+    return True
+
+
+
+# async def safe_download_file(file_url: str, destination: str) -> bool:
+#     """Скачивает файл по прямому URL Telegram."""
+#     for attempt in range(MAX_RETRIES):
+#         try:
+#             async with aiohttp.ClientSession() as session:
+#                 async with session.get(file_url) as resp:
+#                     if resp.status == 200:
+#                         with open(destination, 'wb') as f:
+#                             async for chunk in resp.content.iter_chunked(1024*1024):
+#                                 f.write(chunk)
+#                         return True
+#                     raise aiohttp.ClientError(f"HTTP {resp.status}")
+#         except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+#             if attempt == MAX_RETRIES - 1:
+#                 raise
+#             await asyncio.sleep(2 * (attempt + 1))
+#     return False
+
+# Подготовка медиа: ffprobe + ffmpeg без декодирования в память Python
+@dataclass(frozen=True)
+class EncodingProfile:
+    """Кодек и битрейт, в которых аудио уходит в Whisper"""
+    name: str
+    encoder: str  # Кодер ffmpeg
+    format: str  # Контейнер, он же расширение файла для Whisper
+    bitrate: int  # кбит/с
+    extra: Tuple[str, ...] = ()
+
+    def ffmpeg_args(self) -> List[str]:
+        return ["-c:a", self.encoder, "-b:a", f"{self.bitrate}k", *self.extra, "-f", self.format]
+
+    def estimated_size(self, duration: float) -> float:
+        return duration * self.bitrate * 1000 / 8
+
+    def max_duration(self, size_limit: float) -> float:
+        """Сколько секунд помещается в size_limit байт"""
+        return size_limit * 8 / (self.bitrate * 1000)
+
+
+CODECS = {
+    "mp3": ("libmp3lame", "mp3", ()),
+    "opus": ("libopus", "ogg", ("-application", "voip")),
+}
+
+
+def parse_encoding_profiles(spec: str) -> List[EncodingProfile]:
+    """Разбирает список вида "mp3:64,opus:24" в профили"""
+    profiles = []
+    for item in spec.split(","):
+        codec, _, bitrate = item.strip().partition(":")
+        encoder, fmt, extra = CODECS[codec]
+        profiles.append(EncodingProfile(f"{codec}_{bitrate}k", encoder, fmt, int(bitrate), extra))
+    return profiles
+
+
+ENCODING_PROFILES = parse_encoding_profiles(ENCODING_PROFILES_SPEC)
+UPLOAD_SIZE_LIMIT = MAX_FILE_SIZE * UPLOAD_SIZE_MARGIN
+
+
+def choose_encoding_profile(duration: float, profiles: List[EncodingProfile] = ENCODING_PROFILES) -> EncodingProfile:
+    """Профиль с наименьшим числом запросов к Whisper, при равенстве - самый качественный (первый в списке)"""
+    return min(profiles, key=lambda p: math.ceil(p.estimated_size(duration) / UPLOAD_SIZE_LIMIT))
+
+
+@dataclass
+class PreparedAudio:
+    """Аудиофайл, прошедший этап подготовки, и его метаданные"""
+    path: str  # Для файла в памяти - только имя для логов и загрузки в Whisper
+    duration: float  # Длительность в секундах
+    size: int  # Размер файла в байтах
+    codec: str
+    has_video: bool = False
+    source_duration: float = 0.0  # Длительность исходной записи до удаления пауз
+    data: Optional[bytes] = None  # Содержимое, если файл не сбрасывался на диск
+    profile: Optional[EncodingProfile] = None  # Профиль кодирования, если файл уже перекодирован
+
+    def __post_init__(self):
+        if not self.source_duration:
+            self.source_duration = self.duration
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+
+def _media_input(audio: PreparedAudio) -> Tuple[str, Optional[bytes]]:
+    """Аргумент -i для ffmpeg и данные для stdin: файл в памяти подается через pipe"""
+    return ("pipe:0", audio.data) if audio.in_memory else (audio.path, None)
+
+
+async def _run_media_tool(*args: str, stderr_output: bool = False, timeout: float = MEDIA_TOOL_TIMEOUT, input_data: Optional[bytes] = None) -> bytes:
+    """Запускает ffmpeg/ffprobe как подпроцесс и возвращает stdout (или stderr).
+
+    При таймауте или отмене задачи процесс убивается, чтобы не занимать ядро.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(input_data), timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        if proc.returncode is None:
+            proc.kill()
+            await asyncio.shield(proc.wait())
+        if isinstance(e, asyncio.TimeoutError):
+            raise TimeoutError(f"{args[0]} не уложился в {timeout} сек") from e
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError(f"{args[0]} завершился с кодом {proc.returncode}: {stderr.decode(errors='ignore')[-500:]}")
+    return stderr if stderr_output else stdout
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+async def _packets_duration(data: bytes) -> float:
+    """Длительность потока по временным меткам пакетов: из pipe ffprobe не видит конец файла"""
+    raw = await _run_media_tool(
+        "ffprobe", "-v", "error",
+        "-select_streams", "a:0",
+        "-show_entries", "packet=pts_time,duration_time",
+        "-of", "csv=p=0",
+        "pipe:0",
+        input_data=data
+    )
+    end = 0.0
+    for line in raw.decode(errors="ignore").splitlines():
+        pts, _, length = line.partition(",")
+        end = max(end, _to_float(pts) + _to_float(length))
+    return end
+
+
+async def probe_media(path: str, data: Optional[bytes] = None) -> PreparedAudio:
+    """Читает длительность и параметры потоков через ffprobe, не декодируя файл"""
+    raw = await _run_media_tool(
+        "ffprobe", "-v", "error",
+        "-print_format", "json",
+        "-show_format", "-show_streams",
+        "pipe:0" if data is not None else path,
+        input_data=data
+    )
+    info = json.loads(raw or b"{}")
+    streams = info.get("streams", [])
+    audio_streams = [s for s in streams if s.get("codec_type") == "audio"]
+    if not audio_streams:
+        raise ValueError("В файле нет аудиодорожки")
+    # Обложка альбома в mp3 тоже видеопоток, ее не считаем
+    has_video = any(
+        s.get("codec_type") == "video" and not s.get("disposition", {}).get("attached_pic")
+        for s in streams
+    )
+    fmt = info.get("format", {})
+    duration = _to_float(fmt.get("duration")) or _to_float(audio_streams[0].get("duration"))
+    if not duration and data is not None:
+        duration = await _packets_duration(data)
+    return PreparedAudio(
+        path=path,
+        duration=duration,
+        size=len(data) if data is not None else int(fmt.get("size") or os.path.getsize(path)),
+        codec=audio_streams[0].get("codec_name", ""),
+        has_video=has_video,
+        data=data
+    )
+
+
+async def load_media(data: bytes, name: str) -> PreparedAudio:
+    """Пробует обработать скачанный файл в памяти, иначе сбрасывает его на диск.
+
+    Из pipe не читаются, например, mp4 с индексом (moov) в конце файла.
+    """
+    try:
+        source = await probe_media(name, data)
+        if source.duration:
+            return source
+        logger.info(f"{name}: длительность из потока неизвестна, сохраняю на диск")
+    except RuntimeError as e:
+        logger.info(f"{name}: не читается из потока ({e}), сохраняю на диск")
+    path = os.path.join(tempfile.gettempdir(), f"spill_{uuid.uuid4().hex}_{os.path.basename(name)}")
+    async with aiofiles.open(path, "wb") as f:
+        await f.write(data)
+    try:
+        return await probe_media(path)
+    except Exception:
+        os.remove(path)
+        raise
+
+
+# Допуск файлов до скачивания и перекодирования: решение только по метаданным
+ADMISSION_DECISIONS = Counter("transcribator_admission_total", "Решений о допуске файлов до скачивания", ["source", "decision"])
+ADMISSION_DURATION_SLACK = 1.0  # Telegram округляет длительность до целых секунд
+
+
+@dataclass(frozen=True)
+class Admission:
+    """Решение до скачивания: отклонить с причиной, принять или сразу вести по пути с чанками"""
+    accepted: bool
+    reason: str = ""
+    duration: Optional[float] = None  # None - до скачивания длительность неизвестна
+    chunked: bool = False
+
+    @property
+    def decision(self) -> str:
+        return "reject" if not self.accepted else "chunked" if self.chunked else "accept"
+
+
+def admit_media(size: Optional[int], duration: Optional[float], max_size: int) -> Admission:
+    """Решает по размеру и длительности из метаданных; неизвестные значения проверяются после скачивания"""
+    if size and size > max_size:
+        admission = Admission(False, f"Файл больше {max_size // 1024 // 1024} МБ", duration)
+    elif duration is not None and duration + ADMISSION_DURATION_SLACK < MIN_AUDIO_DURATION:
+        admission = Admission(False, f"Слишком короткое аудио (меньше {MIN_AUDIO_DURATION} секунд)", duration)
+    elif duration is not None and duration > MAX_AUDIO_DURATION:
+        admission = Admission(False, f"Слишком длинная запись (больше {MAX_AUDIO_DURATION / 3600:.0f} ч)", duration)
+    else:
+        # Не влезет в один запрос к Whisper даже после перекодирования - качаем на диск и режем на чанки
+        chunked = bool(duration) and choose_encoding_profile(duration).estimated_size(duration) > UPLOAD_SIZE_LIMIT
+        admission = Admission(True, duration=duration, chunked=chunked)
+    return admission
+
+
+class ProbeProxy:
+    """Локальный HTTP-прокси для ffprobe по удаленным файлам.
+
+    ffprobe получает одноразовый адрес на 127.0.0.1, а настоящий URL (с токеном бота)
+    и заголовок авторизации остаются в процессе: в argv и тексты ошибок они не попадают.
+    Запросы Range передаются как есть, поэтому ffprobe читает только нужные байты.
+    """
+
+    FORWARDED_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges")
+
+    def __init__(self):
+        self._targets = {}
+        self._runner = None
+        self._base_url = None
+        self._session = None
+        self._lock = asyncio.Lock()
+
+    async def _start(self):
+        async with self._lock:
+            if self._runner:
+                return
+            app = web.Application()
+            app.router.add_get("/{key}", self._forward)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self._base_url = f"http://127.0.0.1:{port}"
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60))
+            self._runner = runner
+
+    async def _forward(self, request: web.Request) -> web.StreamResponse:
+        target = self._targets.get(request.match_info["key"])
+        if target is None:
+            return web.Response(status=404)
+        url, headers = target
+        if "Range" in request.headers:
+            headers = {**headers, "Range": request.headers["Range"]}
+        async with self._session.get(url, headers=headers) as upstream:
+            response = web.StreamResponse(
+                status=upstream.status,
+                headers={name: upstream.headers[name] for name in self.FORWARDED_HEADERS if name in upstream.headers}
+            )
+            await response.prepare(request)
+            try:
+                async for block in upstream.content.iter_chunked(64 * 1024):
+                    await response.write(block)
+            except ConnectionResetError:
+                # ffprobe прочитал заголовок и закрыл соединение
+                pass
+            return response
+
+    @asynccontextmanager
+    async def target(self, url: str, headers: Optional[dict] = None):
+        """Одноразовый локальный адрес для url, действует до выхода из блока"""
+        await self._start()
+        key = uuid.uuid4().hex
+        self._targets[key] = (url, headers or {})
+        try:
+            yield f"{self._base_url}/{key}"
+        finally:
+            del self._targets[key]
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+
+probe_proxy = ProbeProxy()
+
+
+async def probe_remote_duration(url: str, headers: Optional[dict] = None) -> Optional[float]:
+    """Длительность удаленного файла: ffprobe через ProbeProxy читает заголовок (и индекс mp4) диапазонами байт"""
+    async with probe_proxy.target(url, headers) as local_url:
+        try:
+            raw = await _run_media_tool(
+                "ffprobe", "-v", "error",
+                "-show_entries", "format=duration",
+                "-of", "csv=p=0",
+                local_url,
+                timeout=ADMISSION_PROBE_TIMEOUT
+            )
+        except Exception as e:
+            # Адреса в тексте ошибки не нужны, а настоящий может содержать токен
+            message = str(e).replace(url, "<url>").replace(local_url, "<url>")
+            logger.info(f"Не удалось узнать длительность до скачивания: {message}")
+            return None
+    return _to_float(raw.decode(errors="ignore").strip()) or None
+
+
+def drive_duration(item: dict) -> Optional[float]:
+    """Длительность из videoMediaMetadata; у аудиофайлов Drive ее не заполняет"""
+    millis = (item.get('videoMediaMetadata') or {}).get('durationMillis')
+    return int(millis) / 1000 if millis else None
+
+
+async def admit_drive_file(file_id: str, size: Optional[int], duration: Optional[float]) -> Admission:
+    """Допуск файла Drive по size и videoMediaMetadata, для крупных аудио - по заголовку через ffprobe"""
+    admission = admit_media(size, duration, MAX_SOURCE_SIZE)
+    source = "drive"
+    if admission.accepted and duration is None and (not size or size > ADMISSION_PROBE_MIN_BYTES):
+        duration = await drive_downloader.probe_duration(file_id)
+        if duration is not None:
+            admission = admit_media(size, duration, MAX_SOURCE_SIZE)
+            source = "drive_probe"
+    ADMISSION_DECISIONS.labels(source, admission.decision).inc()
+    return admission
+
+
+async def prepare_audio(source: PreparedAudio, profile: Optional[EncodingProfile] = None) -> PreparedAudio:
+    """Перекодирует файл сразу в 16 kHz моно средствами ffmpeg.
+
+    Кодек и битрейт выбираются по длительности так, чтобы запросов к Whisper было меньше.
+    """
+    profile = profile or choose_encoding_profile(source.duration)
+    output_path = os.path.join(tempfile.gettempdir(), f"converted_{uuid.uuid4().hex}.{profile.format}")
+    # Результат держим в памяти, если он заведомо небольшой
+    in_memory = profile.estimated_size(source.duration) <= STREAM_SPILL_BYTES
+    input_arg, input_data = _media_input(source)
+    try:
+        async with scheduler.stage("transcode"), track_stage("transcode", profile=profile.name):
+            output = await _run_media_tool(
+                "ffmpeg", "-nostdin", "-y", "-v", "error",
+                "-i", input_arg,
+                "-vn", "-ac", "1", "-ar", "16000",
+                *profile.ffmpeg_args(),
+                "pipe:1" if in_memory else output_path,
+                input_data=input_data
+            )
+        prepared = PreparedAudio(
+            path=output_path,
+            duration=source.duration,
+            size=len(output) if in_memory else os.path.getsize(output_path),
+            codec=profile.format,
+            has_video=source.has_video,
+            data=output if in_memory else None,
+            profile=profile
+        )
+        logger.info(f"{source.path}: {source.duration:.0f} сек в профиле {profile.name}, {prepared.size / 1024 / 1024:.1f} МБ")
+    except Exception as e:
+        logger.error(f"Ошибка конвертации: {e}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    if VAD_ENABLED:
+        try:
+            async with scheduler.stage("transcode"):
+                prepared = await trim_silence(prepared)
+        except Exception as e:
+            logger.warning(f"VAD пропущен: {e}")
+    return prepared
+
+
+async def detect_silences(audio: PreparedAudio, noise: str = SILENCE_NOISE, min_silence: float = SILENCE_MIN_DURATION) -> List[Tuple[float, float]]:
+    """Находит паузы в аудио через ffmpeg silencedetect, возвращает пары (начало, конец) в секундах"""
+    input_arg, input_data = _media_input(audio)
+    log = await _run_media_tool(
+        "ffmpeg", "-nostdin", "-v", "info",
+        "-i", input_arg,
+        "-af", f"silencedetect=noise={noise}:d={min_silence}",
+        "-f", "null", "-",
+        stderr_output=True,
+        input_data=input_data
+    )
+    silences = []
+    start = None
+    for line in log.decode(errors="ignore").splitlines():
+        if "silence_start:" in line:
+            start = float(line.split("silence_start:")[1].split()[0])
+        elif "silence_end:" in line and start is not None:
+            end = float(line.split("silence_end:")[1].split()[0])
+            silences.append((start, end))
+            start = None
+    return silences
+
+
+async def trim_silence(audio: PreparedAudio) -> PreparedAudio:
+    """Вырезает длинные паузы (музыка ожидания, тишина); длительность исходной записи сохраняется в source_duration"""
+    silences = await detect_silences(audio, noise=VAD_NOISE, min_silence=VAD_MIN_SILENCE)
+    pad = VAD_KEEP_SILENCE / 2
+    speech = []
+    pos = 0.0
+    for start, end in silences:
+        cut_start, cut_end = start + pad, min(end, audio.duration) - pad
+        if cut_end <= cut_start:
+            continue
+        if cut_start > pos:
+            speech.append((pos, cut_start))
+        pos = cut_end
+    if pos < audio.duration:
+        speech.append((pos, audio.duration))
+
+    kept = sum(end - start for start, end in speech)
+    removed = audio.duration - kept
+    if not speech or removed < 1:
+        logger.info(f"VAD {audio.path}: удалено 0.0% аудио")
+        return audio
+
+    output_path = os.path.join(tempfile.gettempdir(), f"trimmed_{uuid.uuid4().hex}.{audio.profile.format}")
+    select = "+".join(f"between(t,{start:.3f},{end:.3f})" for start, end in speech)
+    input_arg, input_data = _media_input(audio)
+    try:
+        output = await _run_media_tool(
+            "ffmpeg", "-nostdin", "-y", "-v", "error",
+            "-i", input_arg,
+            "-af", f"aselect='{select}',asetpts=N/SR/TB",
+            "-ac", "1", "-ar", "16000",
+            *audio.profile.ffmpeg_args(),
+            "pipe:1" if audio.in_memory else output_path,
+            input_data=input_data
+        )
+    except Exception as e:
+        logger.warning(f"VAD не удался, использую файл целиком: {e}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return audio
+
+    logger.info(f"VAD {audio.path}: удалено {removed / audio.duration * 100:.1f}% аудио ({removed:.0f} из {audio.duration:.0f} сек)")
+    if not audio.in_memory:
+        os.remove(audio.path)
+    return PreparedAudio(
+        path=output_path,
+        duration=kept,
+        size=len(output) if audio.in_memory else os.path.getsize(output_path),
+        codec=audio.codec,
+        has_video=audio.has_video,
+        source_duration=audio.source_duration,
+        data=output if audio.in_memory else None,
+        profile=audio.profile
+    )
+
+
+def plan_chunks(duration: float, silences: List[Tuple[float, float]], max_len: float, overlap: float = CHUNK_OVERLAP) -> List[Tuple[float, float]]:
+    """Делит запись на отрезки не длиннее max_len, стараясь резать по паузам, с небольшим перекрытием"""
+    chunks = []
+    start = 0.0
+    while start < duration:
+        if start + max_len >= duration:
+            chunks.append((start, duration))
+            break
+        cut = start + max_len - overlap
+        # Середина самой поздней паузы во второй половине окна
+        candidates = [(s + e) / 2 for s, e in silences if start + max_len / 2 < (s + e) / 2 < cut]
+        if candidates:
+            cut = max(candidates)
+        chunks.append((start, min(cut + overlap, duration)))
+        start = cut
+    return chunks
+
+
+def _normalize_word(word: str) -> str:
+    return word.strip(".,!?;:…«»\"'()-—").lower()
+
+
+def stitch_transcripts(texts: List[str], max_overlap_words: int = 40) -> str:
+    """Склеивает тексты чанков по порядку, убирая слова, повторенные в зоне перекрытия"""
+    result = []
+    for text in texts:
+        words = text.split()
+        if result and words:
+            tail = [_normalize_word(w) for w in result[-max_overlap_words:]]
+            head = [_normalize_word(w) for w in words[:max_overlap_words]]
+            for k in range(min(len(tail), len(head)), 1, -1):
+                if tail[-k:] == head[:k]:
+                    words = words[k:]
+                    break
+        result.extend(words)
+    return " ".join(result)
+
+
+async def _transcribe_chunk(audio: PreparedAudio, index: int, start: float, end: float, limit: asyncio.Semaphore) -> str:
+    """Вырезает один чанк и транскрибирует его"""
+    async with limit:
+        chunk_name = f"{os.path.basename(audio.path)}_chunk_{index}.{audio.profile.format}"
+        input_arg, input_data = _media_input(audio)
+        seek = ["-ss", f"{start:.3f}", "-t", f"{end - start:.3f}"]
+        # Файл уже в целевом формате, поэтому режем без перекодирования и сразу в память.
+        # Поток из pipe перемотать нельзя, для него -ss ставится после -i
+        chunk = await _run_media_tool(
+            "ffmpeg", "-nostdin", "-y", "-v", "error",
+            *([*seek, "-i", input_arg] if input_data is None else ["-i", input_arg, *seek]),
+            "-c", "copy",
+            "-f", audio.profile.format, "pipe:1",
+            input_data=input_data
+        )
+
+        # Проверка размера
+        if len(chunk) > MAX_FILE_SIZE:
+            raise ValueError(f"Чанк {index+1} превысил лимит размера")
+
+        # Повторы при отказах и 429 делает whisper_limiter
+        return await transcribe_audio(chunk_name, data=chunk, duration=end - start)
+
+
+async def plan_audio_chunks(audio: PreparedAudio) -> List[Tuple[float, float]]:
+    """Отрезки для транскрибации: каждый помещается в лимит Whisper при битрейте профиля"""
+    # Максимальная длительность чанка по фактическому битрейту профиля
+    max_chunk_duration_sec = audio.profile.max_duration(UPLOAD_SIZE_LIMIT)
+    try:
+        async with scheduler.stage("transcode"):
+            silences = await detect_silences(audio)
+    except Exception as e:
+        logger.warning(f"Не удалось найти паузы, режу по времени: {e}")
+        silences = []
+    chunks = plan_chunks(audio.duration, silences, max_chunk_duration_sec)
+    logger.info(f"Файл {audio.path}: {len(chunks)} чанков, пауз найдено {len(silences)}")
+    return chunks
+
+
+async def process_large_audio(audio: PreparedAudio) -> str:
+    """Разбивает большой файл на чанки и параллельно транскрибирует их"""
+    try:
+        chunks = await plan_audio_chunks(audio)
+
+        limit = asyncio.Semaphore(CHUNK_CONCURRENCY)
+        results = await asyncio.gather(
+            *(_transcribe_chunk(audio, i, start, end, limit) for i, (start, end) in enumerate(chunks)),
+            return_exceptions=True
+        )
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException):
+                raise RuntimeError(f"Чанк {i+1}/{len(chunks)} не удалось транскрибировать: {result}")
+
+        return stitch_transcripts(results)
+    except Exception as e:
+        logger.error(f"Ошибка обработки большого файла: {e}")
+        raise
+
+# Хранилище заданий на обработку папок (SQLite)
+FILE_STAGES = ("pending", "downloaded", "transcribed", "analyzed", "written")
+FILE_FINAL_STATUSES = ("written", "skipped", "failed")
+
+
+class ThreadedStore:
+    """Асинхронная обертка над синхронным SQLite-хранилищем: каждый вызов метода идет в отдельном потоке.
+
+    Базы лежат на общем томе, и ожидание чужой блокировки (до timeout соединения)
+    не должно останавливать цикл событий. Вызовы к одному хранилищу идут по очереди.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+
+    def _locked(self, method, *args, **kwargs):
+        with self._lock:
+            return method(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        method = getattr(self.store, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(self._locked, method, *args, **kwargs)
+        return call
+
+
+class JobStore:
+    """Задания и пофайловые контрольные точки в локальной SQLite, чтобы пережить перезапуск"""
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER,
+                folder_id TEXT NOT NULL,
+                username TEXT,
+                user_data TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                listed INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                owner TEXT,
+                lease_until REAL
+            );
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                mime_type TEXT,
+                md5 TEXT,
+                size INTEGER,
+                modified_time TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                local_path TEXT,
+                duration REAL,
+                transcription TEXT,
+                ai_response TEXT,
+                row_number INTEGER,
+                error TEXT,
+                PRIMARY KEY (job_id, file_id)
+            );
+        """)
+        # Базы, созданные до появления колонок size и modified_time
+        columns = {row['name'] for row in self._db.execute("PRAGMA table_info(job_files)")}
+        if 'size' not in columns:
+            self._db.execute("ALTER TABLE job_files ADD COLUMN size INTEGER")
+        if 'modified_time' not in columns:
+            self._db.execute("ALTER TABLE job_files ADD COLUMN modified_time TEXT")
+        # ... и до появления владельца задания
+        columns = {row['name'] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if 'owner' not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self._db.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+
+    def create_job(self, chat_id: int, message_id: int, folder_id: str, username: str, user_data: dict,
+                   job_id: Optional[str] = None, queued: bool = False) -> str:
+        """Создает задание; queued - задание ждет в очереди без владельца, его заберет claim_job.
+
+        Задание с уже существующим job_id не пересоздается.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        owner, lease_until = (None, None) if queued else (WORKER_ID, time.time() + WORKER_LEASE)
+        self._db.execute(
+            "INSERT OR IGNORE INTO jobs (id, chat_id, message_id, folder_id, username, user_data, status, created_at, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, chat_id, message_id, folder_id, username, json.dumps(user_data, ensure_ascii=False),
+             "queued" if queued else "running", datetime.now().isoformat(), owner, lease_until)
+        )
+        return job_id
+
+    def add_file(self, job_id: str, file: dict) -> Optional[dict]:
+        """Добавляет найденный файл в задание, возвращает его запись или None, если он уже есть"""
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO job_files (job_id, file_id, name, mime_type, md5, size, modified_time, duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, file['id'], file['name'], file.get('mimeType'), file.get('md5Checksum'), file.get('size'), file.get('modifiedTime'), drive_duration(file))
+        )
+        if not cursor.rowcount:
+            return None
+        return self.get_file(job_id, file['id'])
+
+    def get_file(self, job_id: str, file_id: str) -> Optional[dict]:
+        row = self._db.execute("SELECT * FROM job_files WHERE job_id = ? AND file_id = ?", (job_id, file_id)).fetchone()
+        return dict(row) if row else None
+
+    def mark_listed(self, job_id: str):
+        self._db.execute("UPDATE jobs SET listed = 1 WHERE id = ?", (job_id,))
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job['user_data'] = json.loads(job['user_data'])
+        return job
+
+    def claim_job(self, job_id: str) -> bool:
+        """Берет задание в работу, если оно ждет в очереди, принадлежит этому воркеру или брошено.
+
+        Задание, которое ведет другой живой воркер (он продлевает аренду), и завершенное задание не берется.
+        """
+        now = time.time()
+        cursor = self._db.execute(
+            "UPDATE jobs SET status = 'running', owner = ?, lease_until = ? "
+            "WHERE id = ? AND status IN ('queued', 'running') AND (owner = ? OR owner IS NULL OR lease_until < ?)",
+            (WORKER_ID, now + WORKER_LEASE, job_id, WORKER_ID, now)
+        )
+        return bool(cursor.rowcount)
+
+    def unfinished_jobs(self) -> List[str]:
+        """Начатые задания этого воркера и задания, чья аренда истекла; брать их - через claim_job.
+
+        jobs.db лежит на общем томе, поэтому задания, которые прямо сейчас ведут
+        другие живые воркеры, сюда не попадают.
+        """
+        return [row['id'] for row in self._db.execute(
+            "SELECT id FROM jobs WHERE status = 'running' AND (owner = ? OR owner IS NULL OR lease_until < ?) ORDER BY created_at",
+            (WORKER_ID, time.time())
+        )]
+
+    def renew_lease(self, job_id: str):
+        self._db.execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ?",
+            (time.time() + WORKER_LEASE, job_id, WORKER_ID)
+        )
+
+    def job_files(self, job_id: str) -> List[dict]:
+        return [dict(row) for row in self._db.execute("SELECT * FROM job_files WHERE job_id = ? ORDER BY rowid", (job_id,))]
+
+    def update_file(self, job_id: str, file_id: str, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._db.execute(
+            f"UPDATE job_files SET {columns} WHERE job_id = ? AND file_id = ?",
+            (*fields.values(), job_id, file_id)
+        )
+
+    def finish_job(self, job_id: str, status: str = "done"):
+        self._db.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+
+
+job_store = ThreadedStore(JobStore(os.path.join(JOBS_DIR, "jobs.db")))
+
+
+class FolderSyncStore:
+    """Отслеживаемые папки и файлы, уже обработанные из каждой папки для каждого чата.
+
+    Файл считается обработанным, пока не изменились его md5 (или modifiedTime,
+    если md5 у файла нет), поэтому повторная ссылка на папку стоит O(новых файлов).
+    """
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS watched_folders (
+                chat_id INTEGER NOT NULL,
+                folder_id TEXT NOT NULL,
+                chat TEXT NOT NULL,
+                synced_at TEXT,
+                next_sync REAL NOT NULL,
+                PRIMARY KEY (chat_id, folder_id)
+            );
+            CREATE TABLE IF NOT EXISTS processed_files (
+                chat_id INTEGER NOT NULL,
+                folder_id TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                md5 TEXT,
+                modified_time TEXT,
+                PRIMARY KEY (chat_id, folder_id, file_id)
+            );
+        """)
+
+    def is_processed(self, chat_id: int, folder_id: str, item: dict) -> bool:
+        """Файл из files.list уже обработан и с тех пор не менялся"""
+        row = self._db.execute(
+            "SELECT md5, modified_time FROM processed_files WHERE chat_id = ? AND folder_id = ? AND file_id = ?",
+            (chat_id, folder_id, item['id'])
+        ).fetchone()
+        if not row:
+            return False
+        if item.get('md5Checksum') and row['md5']:
+            return item['md5Checksum'] == row['md5']
+        return item.get('modifiedTime') == row['modified_time']
+
+    def remember(self, chat_id: int, folder_id: str, file: dict):
+        self._db.execute(
+            "INSERT OR REPLACE INTO processed_files (chat_id, folder_id, file_id, md5, modified_time) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, folder_id, file['file_id'], file['md5'], file['modified_time'])
+        )
+
+    def add_watch(self, chat: "ChatContext", folder_id: str):
+        """Начинает отслеживать папку; первая синхронизация - при ближайшей проверке"""
+        self._db.execute(
+            "INSERT OR REPLACE INTO watched_folders (chat_id, folder_id, chat, synced_at, next_sync) VALUES (?, ?, ?, NULL, ?)",
+            (chat.chat_id, folder_id, json.dumps(asdict(chat), ensure_ascii=False), time.time())
+        )
+
+    def remove_watch(self, chat_id: int, folder_id: str) -> bool:
+        cursor = self._db.execute("DELETE FROM watched_folders WHERE chat_id = ? AND folder_id = ?", (chat_id, folder_id))
+        return bool(cursor.rowcount)
+
+    def watches(self, chat_id: int) -> List[dict]:
+        return [dict(row) for row in self._db.execute(
+            "SELECT folder_id, synced_at FROM watched_folders WHERE chat_id = ? ORDER BY folder_id", (chat_id,)
+        )]
+
+    def claim_due(self, interval: float) -> List[dict]:
+        """Папки, которым пора синхронизироваться; условный UPDATE не дает двум воркерам взять одну папку"""
+        now = time.time()
+        claimed = []
+        for row in self._db.execute("SELECT * FROM watched_folders WHERE next_sync <= ?", (now,)).fetchall():
+            cursor = self._db.execute(
+                "UPDATE watched_folders SET next_sync = ? WHERE chat_id = ? AND folder_id = ? AND next_sync = ?",
+                (now + interval, row['chat_id'], row['folder_id'], row['next_sync'])
+            )
+            if cursor.rowcount:
+                watch = dict(row)
+                watch['chat'] = json.loads(watch['chat'])
+                claimed.append(watch)
+        return claimed
+
+    def mark_synced(self, chat_id: int, folder_id: str, synced_at: str):
+        self._db.execute(
+            "UPDATE watched_folders SET synced_at = ? WHERE chat_id = ? AND folder_id = ?",
+            (synced_at, chat_id, folder_id)
+        )
+
+
+folder_sync_store = ThreadedStore(FolderSyncStore(WATCH_DB_PATH))
+
+
+# Кэш транскрипций по содержимому файла
+class TranscriptCache:
+    """Кэш готовых транскрипций в SQLite с вытеснением по объему и необязательным TTL.
+
+    Ключи: md5 файла из Drive (или id), file_unique_id из Telegram, sha256 скачанного файла.
+    """
+
+    def __init__(self, path: str, max_bytes: int = TRANSCRIPT_CACHE_MAX_BYTES, ttl: float = TRANSCRIPT_CACHE_TTL):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS transcripts (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                duration REAL NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+
+    def get(self, keys: List[str], count_miss: bool = True) -> Optional[Tuple[str, float]]:
+        """Возвращает (текст, длительность) по первому найденному ключу.
+
+        count_miss=False - поиск не последний для файла (дальше ищем по содержимому),
+        тогда промах засчитает последний поиск, и на файл приходится один промах.
+        """
+        now = time.time()
+        for key in keys:
+            row = self._db.execute("SELECT text, duration, created_at FROM transcripts WHERE key = ?", (key,)).fetchone()
+            if not row:
+                continue
+            if self.ttl and now - row[2] > self.ttl:
+                self._db.execute("DELETE FROM transcripts WHERE key = ?", (key,))
+                continue
+            self._db.execute("UPDATE transcripts SET last_used = ? WHERE key = ?", (now, key))
+            TRANSCRIPT_CACHE_HITS.inc()
+            logger.info(f"Кэш транскрипций: попадание {key}")
+            return row[0], row[1]
+        if keys and count_miss:
+            TRANSCRIPT_CACHE_MISSES.inc()
+        return None
+
+    def put(self, keys: List[str], text: str, duration: float):
+        if not keys:
+            return
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO transcripts (key, text, duration, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            [(key, text, duration, size, now, now) for key in keys]
+        )
+        self._evict(now)
+
+    def _evict(self, now: float):
+        if self.ttl:
+            self._db.execute("DELETE FROM transcripts WHERE created_at < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Удаляем давно не использованные записи, пока не уложимся в лимит
+        for key, size in self._db.execute("SELECT key, size FROM transcripts ORDER BY last_used").fetchall():
+            self._db.execute("DELETE FROM transcripts WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+transcript_cache = ThreadedStore(TranscriptCache(os.path.join(JOBS_DIR, "transcripts.db")))
+
+
+def drive_cache_keys(file: dict) -> List[str]:
+    """Ключи кэша для файла из Google Drive: по содержимому, если Drive отдал md5"""
+    if file.get('md5Checksum'):
+        return [f"md5:{file['md5Checksum']}"]
+    return [f"drive:{file['id']}"]
+
+
+async def content_cache_key(source: PreparedAudio) -> str:
+    """Ключ кэша по sha256 скачанного файла, считается в отдельном потоке"""
+    def _hash():
+        if source.in_memory:
+            return hashlib.sha256(source.data).hexdigest()
+        digest = hashlib.sha256()
+        with open(source.path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    return f"sha256:{await asyncio.to_thread(_hash)}"
+
+
+async def transcribe_prepared(audio: PreparedAudio) -> str:
+    """Транскрибирует подготовленный файл целиком или по чанкам, если он больше лимита Whisper"""
+    AUDIO_SECONDS.inc(audio.duration)
+    if audio.size <= MAX_FILE_SIZE:
+        return await transcribe_audio(audio.path, data=audio.data, duration=audio.duration)
+    return await process_large_audio(audio)
+
+
+async def process_audio_file(audio: PreparedAudio, file_name: str, chat: "ChatContext", cache_keys: List[str] = ()) -> int:
+    """Обрабатывает аудиофайл и возвращает номер строки в Google Sheets"""
+    try:
+        transcription_text = await transcribe_prepared(audio)
+        await transcript_cache.put(list(cache_keys), transcription_text, audio.source_duration)
+        return await process_transcription(transcription_text, audio.source_duration, file_name, chat)
+    except Exception as e:
+        logger.error(f"Ошибка обработки файла: {e}")
+        raise
+
+async def process_transcription(transcription_text: str, duration: float, file_name: str, chat: "ChatContext") -> int:
+    """Анализирует готовую транскрипцию и записывает результат в Google Sheets"""
+    try:
+        file_len = round(duration)
+        assistant_id = chat.user_data.get('ass_token')
+        
+        response_text = await analyze_transcription(transcription_text, assistant_id)
+        
+        return await write_to_google_sheets(
+            transcription_text=transcription_text,
+            ai_response=response_text,
+            file_name=file_name,
+            username=chat.username,
+            user_data=chat.user_data,
+            sheet_n=1,
+            file_len=str(file_len)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка обработки файла: {e}")
+        raise
+
+# Ход выполнения заданий по папкам
+FILE_STATUS_LABELS = {"written": "записан", "skipped": "пропущен", "failed": "ошибка"}
+
+
+def folder_result_line(file: dict) -> str:
+    if file['status'] == "written":
+        return f"✅ {file['name']} - строка {file['row_number']}"
+    if file['status'] == "skipped":
+        return f"⚠️ {file['name']} - {file['error']}"
+    return f"❌ {file['name']} - ошибка: {file['error']}"
+
+
+def folder_report_csv(files: List[dict]) -> bytes:
+    """Отчет по всем файлам задания; BOM нужен, чтобы Excel узнал UTF-8"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["Файл", "Статус", "Строка", "Длительность, сек", "Ошибка"])
+    for file in files:
+        writer.writerow([
+            file['name'],
+            FILE_STATUS_LABELS.get(file['status'], "не обработан"),
+            file['row_number'] or "",
+            round(file['duration']) if file['duration'] else "",
+            file['error'] or ""
+        ])
+    return buffer.getvalue().encode("utf-8-sig")
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f} сек"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds // 3600:.0f} ч {seconds % 3600 / 60:.0f} мин"
+
+
+class FolderProgress:
+    """Одно сообщение о ходе задания, которое редактируется на месте не чаще раза в interval секунд.
+
+    Показывает счетчики, скорость, оценку оставшегося времени и последние результаты;
+    итоговый отчет по всем файлам уходит CSV-документом.
+    """
+
+    def __init__(self, job: dict, files: List[dict], interval: float = PROGRESS_EDIT_INTERVAL, title: str = "📂 Обработка папки"):
+        self.job = job
+        self.interval = interval
+        self.title = title
+        self.listed = bool(job['listed'])
+        self.total = len(files)
+        self.counts = {status: 0 for status in FILE_FINAL_STATUSES}
+        for file in files:
+            if file['status'] in self.counts:
+                self.counts[file['status']] += 1
+        self.recent = deque(maxlen=PROGRESS_RECENT_FILES)
+        self.started = time.monotonic()
+        self.finished_here = 0  # Завершено в этом запуске процесса, по ним считается скорость
+        self.unchanged = 0  # Обработаны раньше и не менялись
+        self.message_id = None
+        self._dirty = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        try:
+            message = await bot.send_message(
+                self.job['chat_id'], self.render(),
+                reply_to_message_id=self.job['message_id'], allow_sending_without_reply=True
+            )
+            self.message_id = message.message_id
+        except Exception as e:
+            logger.warning(f"Не удалось отправить статус задания {self.job['id']}: {e}")
+            return
+        self._task = asyncio.create_task(self._edit_loop())
+
+    def file_found(self):
+        self.total += 1
+        self._dirty.set()
+
+    def file_unchanged(self):
+        self.unchanged += 1
+        self._dirty.set()
+
+    def mark_listed(self):
+        self.listed = True
+        self._dirty.set()
+
+    def file_done(self, file: dict):
+        status = file['status'] if file['status'] in self.counts else "failed"
+        self.counts[status] += 1
+        self.finished_here += 1
+        self.recent.append(folder_result_line(file)[:120])
+        self._dirty.set()
+
+    def render(self) -> str:
+        finished = sum(self.counts.values())
+        lines = [
+            f"{self.title}: {finished} из {self.total}{'' if self.listed else '+'}",
+            f"✅ {self.counts['written']}   ⚠️ {self.counts['skipped']}   ❌ {self.counts['failed']}",
+        ]
+        elapsed = time.monotonic() - self.started
+        if self.finished_here and elapsed > 0:
+            per_second = self.finished_here / elapsed
+            speed = f"⚡ {per_second * 60:.1f} файлов/мин"
+            if self.listed:
+                speed += f", осталось ~{format_eta((self.total - finished) / per_second)}"
+            lines.append(speed)
+        elif scheduler.pending:
+            lines.append(f"⏳ Сейчас в очереди задач: {scheduler.pending}")
+        if self.unchanged:
+            lines.append(f"⏭ Уже обработаны раньше: {self.unchanged}")
+        if not self.listed:
+            lines.append("🔍 Ищу файлы в папке и вложенных папках, обработка идет по мере нахождения...")
+        if self.recent:
+            lines += ["", *self.recent]
+        return "\n".join(lines)
+
+    async def _edit(self, text: str):
+        for attempt in range(3):
+            try:
+                await bot.edit_message_text(text, chat_id=self.job['chat_id'], message_id=self.message_id)
+                return
+            except TelegramRetryAfter as e:
+                # Уперлись в лимит Telegram на редактирование в этом чате
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logger.warning(f"Не удалось обновить статус задания {self.job['id']}: {e}")
+                return
+
+    async def _edit_loop(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            await self._edit(self.render())
+            await asyncio.sleep(self.interval)
+
+    async def finish(self, files: List[dict], error: Optional[Exception] = None):
+        """Последнее обновление статуса и отчет документом; error - сбой обхода папки"""
+        if self._task:
+            self._task.cancel()
+        if error and not files:
+            summary = f"❌ Произошла критическая ошибка при обработке папки: {error}"
+        elif not files:
+            summary = f"✅ Новых файлов нет, уже обработаны раньше: {self.unchanged}" if self.unchanged else "🔍 В папке не найдено аудиофайлов"
+        else:
+            summary = "\n".join([
+                "📊 Итоговый отчет:",
+                f"Всего файлов: {len(files)}",
+                f"Успешно обработано: {self.counts['written']}",
+                f"Пропущено: {self.counts['skipped']}",
+                f"Не удалось обработать: {self.counts['failed']}",
+                *([f"Уже обработаны раньше: {self.unchanged}"] if self.unchanged else []),
+                *([f"❌ Папка обработана не полностью: {error}"] if error else []),
+            ])
+        try:
+            if self.message_id is None:
+                await bot.send_message(self.job['chat_id'], summary, reply_to_message_id=self.job['message_id'], allow_sending_without_reply=True)
+            else:
+                await self._edit(summary)
+            if files:
+                await bot.send_document(
+                    self.job['chat_id'],
+                    BufferedInputFile(folder_report_csv(files), filename=f"report_{self.job['id'][:8]}.csv"),
+                    caption="📄 Результаты по файлам",
+                    reply_to_message_id=self.job['message_id'],
+                    allow_sending_without_reply=True
+                )
+        except Exception as e:
+            logger.error(f"Не удалось отправить отчет по заданию {self.job['id']}: {e}")
+
+
+async def create_folder_job(folder_id: str, chat: "ChatContext", job_id: Optional[str] = None) -> str:
+    """Задание по папке в ожидании исполнителя; с тем же job_id возвращает уже созданное"""
+    return await job_store.create_job(
+        chat_id=chat.chat_id,
+        message_id=chat.message_id,
+        folder_id=folder_id,
+        username=chat.username,
+        user_data=chat.user_data,
+        job_id=job_id,
+        queued=True
+    )
+
+
+async def process_folder(folder_id: str, chat: "ChatContext", job_id: Optional[str] = None) -> bool:
+    """Выполняет задание по папке, если его еще не ведет другой воркер.
+
+    Повторно доставленная задача очереди приходит с тем же job_id и продолжает
+    начатое задание, а не создает второе. Ошибки уходят вызывающему.
+    """
+    # На воркере с отдельной jobs.db задания от бота нет: создаем его с тем же id
+    job_id = await create_folder_job(folder_id, chat, job_id)
+    if not await claim_folder_job(job_id):
+        logger.info(f"Задание {job_id} уже выполняет другой воркер или оно завершено")
+        return False
+    return await run_folder_job(job_id)
+
+
+async def process_job_file(job: dict, file: dict):
+    """Проводит файл задания по этапам, сохраняя результат каждого этапа в job_store"""
+    job_id, file_id, file_name = job['id'], file['file_id'], file['name']
+    job_trace_id.set(f"{job_id[:8]}/{file_id}")
+    status = file['status']
+    stage = FILE_STAGES.index(status)
+    if status == "downloaded" and not os.path.exists(file['local_path'] or ""):
+        stage = FILE_STAGES.index("pending")
+
+    cache_keys = drive_cache_keys({'id': file_id, 'md5Checksum': file['md5']})
+    if stage < FILE_STAGES.index("transcribed"):
+        cached = await transcript_cache.get(cache_keys, count_miss=False)
+        if cached:
+            transcription, duration = cached
+            await job_store.update_file(job_id, file_id, status="transcribed", duration=duration, transcription=transcription)
+            file.update(duration=duration, transcription=transcription)
+            stage = FILE_STAGES.index("transcribed")
+
+    data = None
+    if stage < FILE_STAGES.index("downloaded"):
+        # До скачивания: длительность из videoMediaMetadata (записана при обходе папки) или из заголовка файла
+        admission = await admit_drive_file(file_id, file['size'], file['duration'])
+        if not admission.accepted:
+            await job_store.update_file(job_id, file_id, status="skipped", error=admission.reason)
+            return
+        if 0 < (file['size'] or 0) <= STREAM_SPILL_BYTES and not admission.chunked:
+            # Небольшой файл держим в памяти: после перезапуска его дешевле скачать заново
+            buffer = bytearray()
+            if not await download_from_google_drive(file_id, buffer, file['size']):
+                raise RuntimeError("ошибка скачивания")
+            data = bytes(buffer)
+        else:
+            input_path = os.path.join(JOBS_DIR, "downloads", f"{job_id}_{file_id}")
+            Path(input_path).parent.mkdir(parents=True, exist_ok=True)
+            if not await download_from_google_drive(file_id, input_path, file['size']):
+                raise RuntimeError("ошибка скачивания")
+            await job_store.update_file(job_id, file_id, status="downloaded", local_path=input_path)
+            file['local_path'] = input_path
+            stage = FILE_STAGES.index("downloaded")
+
+    if stage < FILE_STAGES.index("transcribed"):
+        input_path = file['local_path'] if data is None else None
+        source = prepared = None
+        try:
+            if data is not None:
+                source = await load_media(data, f"{job_id}_{file_id}_{os.path.basename(file_name)}")
+            else:
+                source = await probe_media(input_path)
+            if source.duration < MIN_AUDIO_DURATION:
+                await job_store.update_file(job_id, file_id, status="skipped", error="слишком короткое аудио (меньше 3 сек)")
+                return
+            content_key = await content_cache_key(source)
+            cached = await transcript_cache.get([content_key])
+            if cached:
+                transcription, duration = cached
+            else:
+                # Видео и аудио одинаково перекодируются в 16 kHz моно, кодек (MP3 или Opus) выбирается по длительности
+                try:
+                    prepared = await prepare_audio(source)
+                except Exception:
+                    raise RuntimeError("ошибка конвертации")
+                transcription = await transcribe_prepared(prepared)
+                duration = prepared.source_duration
+            await transcript_cache.put(cache_keys + [content_key], transcription, duration)
+        finally:
+            for path in [input_path, source.path if source else None, prepared.path if prepared else None]:
+                if path and os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except:
+                        pass
+        await job_store.update_file(job_id, file_id, status="transcribed", duration=duration, transcription=transcription, local_path=None)
+        file.update(duration=duration, transcription=transcription)
+        stage = FILE_STAGES.index("transcribed")
+
+    if stage < FILE_STAGES.index("analyzed"):
+        ai_response = await analyze_transcription(file['transcription'], job['user_data'].get('ass_token'))
+        await job_store.update_file(job_id, file_id, status="analyzed", ai_response=ai_response)
+        file['ai_response'] = ai_response
+
+    row_number = await write_to_google_sheets(
+        transcription_text=file['transcription'],
+        ai_response=file['ai_response'],
+        file_name=file_name,
+        username=job['username'],
+        user_data=job['user_data'],
+        sheet_n=1,
+        file_len=str(round(file['duration']))
+    )
+    await job_store.update_file(job_id, file_id, status="written", row_number=row_number)
+
+
+running_jobs = set()  # Задания, которые выполняются в этом процессе
+
+
+async def claim_folder_job(job_id: str) -> bool:
+    """Берет задание в работу этим процессом.
+
+    Проверка и пометка в running_jobs идут без await, поэтому задача очереди
+    и resume_folder_jobs не запустят одно задание дважды.
+    """
+    if job_id in running_jobs:
+        return False
+    running_jobs.add(job_id)
+    if await job_store.claim_job(job_id):
+        return True
+    running_jobs.discard(job_id)
+    return False
+
+
+async def run_folder_job(job_id: str) -> bool:
+    """Выполняет (или продолжает после перезапуска) задание по папке, показывая ход в одном сообщении"""
+
+    async def keep_lease():
+        # Пока задание идет, другие воркеры его не заберут
+        while True:
+            await asyncio.sleep(WORKER_LEASE / 3)
+            await job_store.renew_lease(job_id)
+
+    running_jobs.add(job_id)
+    lease = asyncio.create_task(keep_lease())
+    try:
+        job = await job_store.get_job(job_id)
+        files = await job_store.job_files(job_id)
+        progress = FolderProgress(job, files)
+        await progress.start()
+        return await _run_folder_job_files(job, files, progress)
+    finally:
+        lease.cancel()
+        running_jobs.discard(job_id)
+
+
+async def _run_folder_job_files(job: dict, files: List[dict], progress: "FolderProgress") -> bool:
+    job_id = job['id']
+
+    async def process_single_file_wrapper(file: dict):
+        try:
+            await process_job_file(job, file)
+        except Exception as e:
+            logging.error(f"Ошибка обработки {file['name']}: {e}")
+            await job_store.update_file(job_id, file['file_id'], status="failed", error=str(e))
+        file = await job_store.get_file(job_id, file['file_id'])
+        if file['status'] in ("written", "skipped"):
+            # Неудачные файлы не запоминаем: их возьмет следующая ссылка или синхронизация
+            await folder_sync_store.remember(job['chat_id'], job['folder_id'], file)
+        progress.file_done(file)
+
+    def submit(file: dict) -> asyncio.Future:
+        # Файлы папки идут через общую очередь наравне с задачами других пользователей
+        return scheduler.submit(job['chat_id'], lambda: process_single_file_wrapper(file))
+
+    # Ставим в очередь только незавершенные файлы
+    tasks = [submit(file) for file in files if file['status'] not in FILE_FINAL_STATUSES]
+    listing_error = None
+    if not job['listed']:
+        # Обработка файла начинается сразу, не дожидаясь конца обхода папки
+        try:
+            async def unchanged(item: dict) -> bool:
+                if await folder_sync_store.is_processed(job['chat_id'], job['folder_id'], item):
+                    progress.file_unchanged()
+                    return True
+                return False
+
+            async for item in iter_folder_files(job['folder_id'], skip=unchanged):
+                file = await job_store.add_file(job_id, item)
+                if file:
+                    progress.file_found()
+                    tasks.append(submit(file))
+        except Exception as e:
+            # Уже найденные файлы дорабатываем, но задание не считаем выполненным
+            logger.error(f"Ошибка обхода папки {job['folder_id']}: {e}")
+            listing_error = e
+        else:
+            await job_store.mark_listed(job_id)
+        progress.mark_listed()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await job_store.finish_job(job_id, status="failed" if listing_error else "done")
+
+    files = await job_store.job_files(job_id)
+    await progress.finish(files, listing_error)
+    return bool(files) and not listing_error
+
+
+background_tasks = set()  # Ссылки на фоновые задачи, иначе сборщик мусора может снять их на ходу
+
+
+def _background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Фоновая задача {task.get_name()} завершилась ошибкой", exc_info=task.exception())
+
+
+def spawn(coro, name: Optional[str] = None) -> asyncio.Task:
+    """Запускает фоновую задачу, хранит ссылку на нее и логирует необработанную ошибку"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+
+async def resume_folder_jobs():
+    """Продолжает задания, прерванные перезапуском этого воркера, и брошенные упавшими воркерами"""
+    for job_id in await job_store.unfinished_jobs():
+        if await claim_folder_job(job_id):
+            logger.info(f"Продолжаю задание {job_id}")
+            spawn(run_folder_job(job_id), name=f"job/{job_id}")
+
+
+async def sync_watched_folder(watch: dict):
+    """Один цикл синхронизации: только новые и измененные с прошлой проверки файлы, один отчет на цикл"""
+    chat = ChatContext(**watch['chat'])
+    folder_id = watch['folder_id']
+    job_trace_id.set(f"watch/{folder_id}")
+    cycle_started = (datetime.now(timezone.utc) - timedelta(seconds=WATCH_CLOCK_SKEW)).strftime("%Y-%m-%dT%H:%M:%S")
+    try:
+        items = []
+        listing_error = None
+        try:
+            async for item in iter_folder_files(
+                folder_id, modified_after=watch['synced_at'],
+                skip=lambda item: folder_sync_store.is_processed(chat.chat_id, folder_id, item)
+            ):
+                items.append(item)
+        except FolderListingError as e:
+            # Время прошлой проверки не сдвигаем: непрочитанные папки и файлы сверх лимита
+            # возьмем в следующем цикле, а найденные сейчас к тому времени будут помечены обработанными
+            logger.error(f"Папка {folder_id} прочитана не полностью: {e}")
+            listing_error = e
+        if not items:
+            if not listing_error:
+                await folder_sync_store.mark_synced(chat.chat_id, folder_id, cycle_started)
+            return
+        job_id = await create_folder_job(folder_id, chat)
+        # Берем задание до записи файлов: брошенное на середине, его продолжит другой воркер
+        await claim_folder_job(job_id)
+        try:
+            for item in items:
+                await job_store.add_file(job_id, item)
+            await job_store.mark_listed(job_id)
+            if not listing_error:
+                # Файлы уже в задании и переживут перезапуск, поэтому цикл считается пройденным
+                await folder_sync_store.mark_synced(chat.chat_id, folder_id, cycle_started)
+            logger.info(f"Папка {folder_id}: новых или измененных файлов {len(items)}")
+            await run_folder_job(job_id)
+        finally:
+            running_jobs.discard(job_id)
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации папки {folder_id}: {e}")
+
+
+async def run_folder_watcher():
+    """Периодически синхронизирует отслеживаемые папки"""
+    running = set()
+    while True:
+        try:
+            for watch in await folder_sync_store.claim_due(WATCH_INTERVAL):
+                key = (watch['chat_id'], watch['folder_id'])
+                if key in running:
+                    continue
+                running.add(key)
+                task = spawn(sync_watched_folder(watch), name=f"watch/{watch['folder_id']}")
+                task.add_done_callback(lambda _, key=key: running.discard(key))
+        except Exception as e:
+            logger.error(f"Ошибка проверки отслеживаемых папок: {e}")
+        await asyncio.sleep(WATCH_TICK)
+
+
+# Задачи обработки и общая очередь между процессами bot и worker
+@dataclass
+class ChatContext:
+    """Откуда пришла задача и куда отвечать; сериализуется вместе с задачей для воркеров"""
+    chat_id: int
+    message_id: int
+    user_id: int
+    username: str
+    user_data: dict
+
+    @classmethod
+    async def from_message(cls, message: types.Message, state: FSMContext) -> "ChatContext":
+        data = await state.get_data()
+        return cls(
+            chat_id=message.chat.id,
+            message_id=message.message_id,
+            user_id=message.from_user.id,
+            username=message.from_user.username or str(message.from_user.id),
+            user_data={key: data.get(key) for key in ('ass_token', 'company_name', 'sheet_id_token')}
+        )
+
+    async def reply(self, text: str):
+        return await bot.send_message(self.chat_id, text, reply_to_message_id=self.message_id, allow_sending_without_reply=True)
+
+
+class SQLiteWorkQueue:
+    """Очередь задач в SQLite-файле, общем для процессов на одном томе.
+
+    Взятая задача арендуется на WORKER_LEASE: воркер продлевает аренду, пока
+    выполняет задачу, а задачу упавшего воркера после истечения аренды возьмет другой.
+    Запросы к базе идут в отдельном потоке: ожидание блокировки другого процесса
+    не останавливает цикл событий.
+    """
+
+    def __init__(self, path: str, worker_id: str = WORKER_ID, poll_interval: float = 1.0, lease: float = WORKER_LEASE):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.worker_id = worker_id
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS work_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                worker TEXT,
+                created_at REAL NOT NULL,
+                lease_until REAL
+            )
+        """)
+        # Очереди, созданные до появления аренды
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(work_queue)")}
+        if 'lease_until' not in columns:
+            self._db.execute("ALTER TABLE work_queue ADD COLUMN lease_until REAL")
+
+    def _locked(self, func, *args):
+        with self._lock:
+            return func(*args)
+
+    async def _execute(self, sql: str, params: tuple = ()):
+        await asyncio.to_thread(self._locked, self._db.execute, sql, params)
+
+    async def put(self, task: dict):
+        await self._execute(
+            "INSERT INTO work_queue (payload, created_at) VALUES (?, ?)",
+            (json.dumps(task, ensure_ascii=False), time.time())
+        )
+
+    def _claim(self) -> Optional[Tuple[dict, int]]:
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute(
+                "SELECT id, payload FROM work_queue WHERE worker IS NULL OR lease_until < ? ORDER BY id LIMIT 1", (now,)
+            ).fetchone()
+            if row:
+                self._db.execute(
+                    "UPDATE work_queue SET worker = ?, lease_until = ? WHERE id = ?",
+                    (self.worker_id, now + self.lease, row[0])
+                )
+        finally:
+            self._db.execute("COMMIT")
+        return (json.loads(row[1]), row[0]) if row else None
+
+    async def get(self) -> Tuple[dict, int]:
+        """Забирает задачу и возвращает ее вместе с квитанцией для ack"""
+        while True:
+            claimed = await asyncio.to_thread(self._locked, self._claim)
+            if claimed:
+                return claimed
+            await asyncio.sleep(self.poll_interval)
+
+    async def ack(self, receipt: int):
+        await self._execute("DELETE FROM work_queue WHERE id = ?", (receipt,))
+
+    async def retry(self, receipt: int, task: dict):
+        """Возвращает задачу в очередь (с обновленным счетчиком попыток)"""
+        await self._execute(
+            "UPDATE work_queue SET payload = ?, worker = NULL, lease_until = NULL WHERE id = ?",
+            (json.dumps(task, ensure_ascii=False), receipt)
+        )
+
+    async def extend(self, receipt: int):
+        await self._execute("UPDATE work_queue SET lease_until = ? WHERE id = ?", (time.time() + self.lease, receipt))
+
+    async def requeue_expired(self):
+        """Возвращает в очередь задачи, аренду которых никто не продлил (воркер упал или перезапущен)"""
+        await self._execute("UPDATE work_queue SET worker = NULL, lease_until = NULL WHERE lease_until < ?", (time.time(),))
+
+
+class RedisWorkQueue:
+    """Очередь задач в Redis: список задач, список взятых в работу и срок аренды каждой взятой задачи"""
+
+    def __init__(self, url: str, name: str = "transcribator:tasks", lease: float = WORKER_LEASE):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url, decode_responses=True)
+        self.name = name
+        self.processing = f"{name}:processing"
+        self.leases = f"{name}:leases"
+        self.lease = lease
+
+    async def put(self, task: dict):
+        # id делает одинаковые задачи различимыми в списке взятых
+        await self._redis.lpush(self.name, json.dumps({**task, 'id': task.get('id') or uuid.uuid4().hex}, ensure_ascii=False))
+
+    async def get(self) -> Tuple[dict, str]:
+        while True:
+            # Ждем не бесконечно, чтобы оборванное соединение не подвешивало воркер
+            raw = await self._redis.blmove(self.name, self.processing, 5, "RIGHT", "LEFT")
+            if raw is not None:
+                break
+            await asyncio.sleep(0.1)
+        await self._redis.zadd(self.leases, {raw: time.time() + self.lease})
+        return json.loads(raw), raw
+
+    async def ack(self, receipt: str):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            await pipe.lrem(self.processing, 1, receipt).zrem(self.leases, receipt).execute()
+
+    async def retry(self, receipt: str, task: dict):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(self.processing, 1, receipt).zrem(self.leases, receipt)
+            await pipe.lpush(self.name, json.dumps(task, ensure_ascii=False)).execute()
+
+    async def extend(self, receipt: str):
+        await self._redis.zadd(self.leases, {receipt: time.time() + self.lease}, xx=True)
+
+    async def requeue_expired(self):
+        """Возвращает в очередь задачи с истекшей арендой.
+
+        Задача, взятая воркером, упавшим до записи аренды, получает аренду здесь
+        и вернется в очередь при одной из следующих проверок.
+        """
+        now = time.time()
+        for raw in await self._redis.lrange(self.processing, 0, -1):
+            await self._redis.zadd(self.leases, {raw: now + self.lease}, nx=True)
+        for raw in await self._redis.zrangebyscore(self.leases, "-inf", now):
+            async with self._redis.pipeline(transaction=True) as pipe:
+                removed, _ = await pipe.lrem(self.processing, 1, raw).zrem(self.leases, raw).execute()
+            if removed:
+                await self._redis.rpush(self.name, raw)
+
+
+def create_work_queue():
+    if WORK_QUEUE == "redis":
+        return RedisWorkQueue(REDIS_URL)
+    return SQLiteWorkQueue(WORK_QUEUE_PATH)
+
+
+work_queue = create_work_queue() if PROCESS_ROLE != "all" else None
+
+
+async def execute_task(task: dict):
+    """Выполняет задачу в этом процессе; файлы идут через общий планировщик"""
+    chat = ChatContext(**task['chat'])
+    if task['kind'] == "folder":
+        # Папка сама раскладывает файлы по планировщику, поэтому слот ей не нужен
+        await process_folder(task['folder_id'], chat, task.get('job_id'))
+    elif task['kind'] == "drive_link":
+        await scheduler.run(chat.user_id, lambda: process_drive_link(task['file_id'], chat), chat)
+    elif task['kind'] == "tg_album":
+        # Как и папка, альбом раскладывает файлы по планировщику сам
+        await process_tg_album(task['files'], chat)
+    elif task['kind'] == "tg_file":
+        await scheduler.run(
+            chat.user_id,
+            lambda: process_tg_media(task['file_id'], task['file_unique_id'], task['ext'], task['file_name'], chat, task.get('duration')),
+            chat
+        )
+    elif task['kind'] in WATCH_TASKS:
+        await manage_watch(task['kind'], task.get('folder_id'), chat)
+    else:
+        logger.error(f"Неизвестный тип задачи: {task['kind']}")
+
+
+# Отслеживаемые папки хранятся там, где работает run_folder_watcher, поэтому
+# команды /watch и /unwatch процесс bot тоже отправляет воркерам через очередь
+WATCH_TASKS = ("watch", "unwatch", "watches")
+
+
+async def manage_watch(kind: str, folder_id: Optional[str], chat: "ChatContext"):
+    if kind == "watch":
+        await folder_sync_store.add_watch(chat, folder_id)
+        await chat.reply(
+            f"👀 Папка отслеживается, проверка раз в {WATCH_INTERVAL / 60:.0f} мин. "
+            "Обрабатываться будут только новые и измененные файлы. Отключить: /unwatch <ссылка>"
+        )
+    elif kind == "unwatch":
+        if await folder_sync_store.remove_watch(chat.chat_id, folder_id):
+            await chat.reply("✅ Папка больше не отслеживается")
+        else:
+            await chat.reply("❌ Эта папка не отслеживается. Список папок: /watch")
+    else:
+        watches = await folder_sync_store.watches(chat.chat_id)
+        if not watches:
+            await chat.reply("Отслеживаемых папок нет. Отправьте /watch <ссылка на папку Google Drive>")
+            return
+        lines = [f"• {w['folder_id']} - проверена {w['synced_at'] or 'еще не проверялась'}" for w in watches]
+        await chat.reply("👀 Отслеживаемые папки:\n" + "\n".join(lines))
+
+
+async def dispatch_task(task: dict):
+    """В процессе bot отдает задачу воркерам через общую очередь, иначе выполняет сама"""
+    chat = ChatContext(**task['chat'])
+    if task['kind'] == "folder":
+        # Задание создается до очереди: повторная доставка задачи продолжит его, а не начнет второе
+        task = {**task, 'job_id': await create_folder_job(task['folder_id'], chat)}
+    if PROCESS_ROLE == "bot":
+        await work_queue.put(task)
+        if task['kind'] not in WATCH_TASKS:
+            await chat.reply("📥 Задача принята, обработка начнется в порядке очереди")
+        return
+    try:
+        await execute_task(task)
+    except Exception as e:
+        logger.exception(f"Ошибка задачи {task['kind']}: {e}")
+        await chat.reply(f"❌ Ошибка обработки: {e}")
+
+
+async def run_task_consumer():
+    """Цикл воркера: берет задачи из общей очереди, не больше SCHEDULER_WORKERS одновременно"""
+    await work_queue.requeue_expired()
+    in_flight = asyncio.Semaphore(SCHEDULER_WORKERS)
+    receipts = set()
+
+    async def handle(task: dict, receipt):
+        receipts.add(receipt)
+        try:
+            await execute_task(task)
+        except Exception as e:
+            attempts = task.get('attempts', 0) + 1
+            logger.exception(f"Ошибка задачи {task.get('kind')} (попытка {attempts}): {e}")
+            if attempts < TASK_MAX_ATTEMPTS:
+                await work_queue.retry(receipt, {**task, 'attempts': attempts})
+            else:
+                logger.error(f"Задача {task.get('kind')} отброшена после {attempts} попыток")
+                await work_queue.ack(receipt)
+                try:
+                    await ChatContext(**task['chat']).reply(f"❌ Ошибка обработки: {e}")
+                except Exception as reply_error:
+                    logger.warning(f"Не удалось сообщить об ошибке задачи: {reply_error}")
+        else:
+            await work_queue.ack(receipt)
+        finally:
+            receipts.discard(receipt)
+            in_flight.release()
+
+    async def keep_leases():
+        # Продлеваем аренду своих задач, возвращаем в очередь брошенные чужие
+        # и забираем задания по папкам, которые вел упавший и не вернувшийся воркер
+        while True:
+            await asyncio.sleep(WORKER_LEASE / 3)
+            for receipt in list(receipts):
+                await work_queue.extend(receipt)
+            await work_queue.requeue_expired()
+            await resume_folder_jobs()
+
+    leases = asyncio.create_task(keep_leases())
     try:
-        service = await get_google_drive_service()
-        request = service.files().get_media(fileId=file_id)
-        
-        fh = io.FileIO(destination, 'wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            logging.info(f"Download {int(status.progress() * 100)}%.")
-        
+        while True:
+            await in_flight.acquire()
+            task, receipt = await work_queue.get()
+            spawn(handle(task, receipt), name=f"task/{task.get('kind')}")
+    finally:
+        leases.cancel()
+
+
+# Разбор имени файла: дата и телефон без запроса к LLM
+EMPTY_FIELD = "Empty"
+PHONE_RE = re.compile(r"(?<!\d)(?:\+?7|8)[\s\-()]*\d{3}[\s\-()]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}(?!\d)|(?<!\d)9\d{9}(?!\d)")
+DATE_PATTERNS = [
+    # 2024-05-12, 2024.05.12, 2024_05_12, 20240512 (но не внутри длинного числа)
+    re.compile(r"(?<!\d)(?P<year>20\d{2})(?P<sep>[-._]?)(?P<month>\d{2})(?P=sep)(?P<day>\d{2})(?!\d)"),
+    # 20240512101530 / 20240512-1015: дата слитно со временем
+    re.compile(r"(?<!\d)(?P<year>20\d{2})(?P<month>\d{2})(?P<day>\d{2})(?=\d{4}(?:\d{2})?(?!\d))"),
+    # 12.05.2024, 12-05-24, 12_05_2024
+    re.compile(r"(?<!\d)(?P<day>\d{1,2})(?P<sep>[-._])(?P<month>\d{1,2})(?P=sep)(?P<year>20\d{2}|\d{2})(?!\d)"),
+]
+
+
+def format_phone(raw: str) -> str:
+    """Приводит номер к формату +7 999 999-99-99"""
+    digits = re.sub(r"\D", "", raw)[-10:]
+    return f"+7 {digits[:3]} {digits[3:6]}-{digits[6:8]}-{digits[8:]}"
+
+
+def _file_name_shape(file_name: str) -> str:
+    """Форма имени: цифры -> 0, буквы -> a; у имен одной формы поля стоят на тех же позициях"""
+    return re.sub(r"[^\W\d_]", "a", re.sub(r"\d", "0", file_name))
+
+
+def _valid_date(day: str, month: str, year: str) -> bool:
+    try:
+        datetime(int(year) if len(year) == 4 else 2000 + int(year), int(month), int(day))
         return True
-    except Exception as e:
-        logger.error(f"Ошибка загрузки из Google Drive: {e}")
+    except ValueError:
         return False
 
-async def list_files_in_folder(folder_id: str) -> List[dict]:
-    """Возвращает список аудио и видео файлов"""
-    service = await get_google_drive_service()
-    response = service.files().list(
-        q=f"'{folder_id}' in parents and (mimeType contains 'audio/' or mimeType contains 'video/' or mimeType contains 'application/octet-stream')",
-        fields="files(id, name, mimeType)",
-        pageSize=MAX_FILES_PER_FOLDER
-    ).execute()
-    return response.get('files', [])
 
+def parse_file_name(file_name: str) -> Optional[Tuple[str, str, str, str]]:
+    """Ищет в имени файла дату и телефон по известным шаблонам.
 
-async def safe_download_file(file: types.File, destination: str) -> bool:
-    """Безопасное скачивание файла с повторными попытками"""
-    for attempt in range(MAX_RETRIES):
-        try:
-            await bot.download(file, destination=destination)
-            return True
-        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-            if attempt == MAX_RETRIES - 1:
-                raise
-            await asyncio.sleep(2 * (attempt + 1))
+    Возвращает (день, месяц, год, телефон) или None, если в имени остались
+    неразобранные цифры и без LLM не обойтись.
+    """
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    phone = EMPTY_FIELD
+    match = PHONE_RE.search(name)
+    if match:
+        phone = format_phone(match.group())
+        name = name[:match.start()] + " " + name[match.end():]
+
+    day = month = year = EMPTY_FIELD
+    for pattern in DATE_PATTERNS:
+        for match in pattern.finditer(name):
+            if _valid_date(match["day"], match["month"], match["year"]):
+                day, month = match["day"].zfill(2), match["month"].zfill(2)
+                year = match["year"] if len(match["year"]) == 4 else f"20{match['year']}"
+                name = name[:match.start()] + " " + name[match.end():]
+                break
+        if day != EMPTY_FIELD:
+            break
+
+    # Если чего-то не нашли, а в имени остались длинные числа, шаблон нам незнаком
+    if (phone == EMPTY_FIELD or day == EMPTY_FIELD) and re.search(r"\d{6,}|\d+\D\d+\D\d+", name):
+        return None
+    return day, month, year, phone
+
+
+def _learn_template(file_name: str, fields: Tuple[str, str, str, str]) -> Optional[dict]:
+    """Находит в имени позиции значений, которые вернул LLM, чтобы разбирать такие имена локально"""
+    spans = {}
+    for key, value in zip(("day", "month", "year", "phone"), fields):
+        digits = re.sub(r"\D", "", value)
+        if not digits:
             continue
-        except Exception as e:
-            raise
-    return False
+        if key == "phone":
+            digits = digits[-10:]
+        variants = [digits, digits.lstrip("0"), digits[-2:]] if key != "phone" else [digits]
+        for variant in variants:
+            if not variant:
+                continue
+            # Пропускаем уже занятые места: в 05-05 день и месяц - разные числа
+            match = next((
+                m for m in re.finditer(r"(?<!\d)" + r"[\s\-().]*".join(variant) + r"(?!\d)", file_name)
+                if not any(m.start() < end and start < m.end() for start, end in spans.values())
+            ), None)
+            if match:
+                spans[key] = match.span()
+                break
+        else:
+            return None
+    return spans
 
 
+def _apply_template(file_name: str, spans: dict) -> Tuple[str, str, str, str]:
+    values = {key: file_name[start:end] for key, (start, end) in spans.items()}
+    year = values.get("year", EMPTY_FIELD)
+    if len(year) == 2:
+        year = f"20{year}"
+    return (
+        values["day"].zfill(2) if "day" in values else EMPTY_FIELD,
+        values["month"].zfill(2) if "month" in values else EMPTY_FIELD,
+        year,
+        format_phone(values["phone"]) if "phone" in values else EMPTY_FIELD
+    )
 
-# async def safe_download_file(file_url: str, destination: str) -> bool:
-#     """Скачивает файл по прямому URL Telegram."""
-#     for attempt in range(MAX_RETRIES):
-#         try:
-#             async with aiohttp.ClientSession() as session:
-#                 async with session.get(file_url) as resp:
-#                     if resp.status == 200:
-#                         with open(destination, 'wb') as f:
-#                             async for chunk in resp.content.iter_chunked(1024*1024):
-#                                 f.write(chunk)
-#                         return True
-#                     raise aiohttp.ClientError(f"HTTP {resp.status}")
-#         except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-#             if attempt == MAX_RETRIES - 1:
-#                 raise
-#             await asyncio.sleep(2 * (attempt + 1))
-#     return False
 
-async def convert_audio(input_path: str) -> str:
-    """Конвертирует аудио в MP3"""
-    unique_id = uuid.uuid4().hex
-    output_path = os.path.join(tempfile.gettempdir(), f"converted_{unique_id}.mp3")  # Изменили на MP3
-    
-    try:
-        audio = AudioSegment.from_file(input_path)
-        
-        # Оптимальные параметры для уменьшения размера
-        audio = audio.set_channels(1)  # Моно
-        audio = audio.set_frame_rate(16000)  # 16 kHz
-        
-        audio.export(
-            output_path,
-            format="mp3",  
-            bitrate="64k"  
-        )
-        
-        if os.path.getsize(output_path) > MAX_FILE_SIZE:
-            raise ValueError("Файл слишком большой после конвертации")
-            
-        return output_path
-    except Exception as e:
-        logger.error(f"Ошибка конвертации: {e}")
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        return None
+class FileNameParser:
+    """Разбирает имена файлов локально, LLM вызывается только для незнакомых форм имен.
 
-async def process_large_audio(file_path: str) -> str:
-    """Разбивает большой файл на чанки в MP3"""
-    try:
-        audio = AudioSegment.from_file(file_path)
-        all_texts = []
-        
-        # Рассчитываем максимальную длительность чанка (MP3 ~64kbps)
-        max_chunk_duration_sec = (MAX_FILE_SIZE * 4) / 64000  # 64kbps в битах
-        chunk_duration_ms = int(max_chunk_duration_sec * 1000)
-        
-        num_chunks = math.ceil(len(audio) / chunk_duration_ms)
-        
-        for i in range(num_chunks):
-            start = i * chunk_duration_ms
-            end = min((i + 1) * chunk_duration_ms, len(audio))
-            chunk = audio[start:end]
-            
-            chunk_path = f"{file_path}_chunk_{i}.mp3"  # Изменили на MP3
+    Шаблоны, выученные по ответам LLM, хранятся в LRU-кэше по форме имени
+    и при заданном FILENAME_PATTERNS_PATH сохраняются на диск.
+    """
+
+    def __init__(self, cache_size: int = FILENAME_CACHE_SIZE, path: Optional[str] = FILENAME_PATTERNS_PATH):
+        self.cache_size = cache_size
+        self.path = path
+        self._templates = OrderedDict()
+        if path and os.path.exists(path):
             try:
-                chunk.export(
-                    chunk_path,
-                    format="mp3",  # Экспорт в MP3
-                    bitrate="64k",
-                    parameters=["-ar", "16000"]  # Частота 16kHz
-                )
-                
-                # Проверка размера
-                if os.path.getsize(chunk_path) > MAX_FILE_SIZE:
-                    raise ValueError(f"Чанк {i+1} превысил лимит размера")
-                
-                # Обработка
-                with open(chunk_path, "rb") as f:
-                    transcript = client.audio.transcriptions.create(
-                        file=f,
-                        model="whisper-1",
-                        language="ru"
-                    )
-                    all_texts.append(transcript.text)
-            finally:
-                if os.path.exists(chunk_path):
-                    os.remove(chunk_path)
-        
-        return "\n\n".join(f"🔹 Часть {i+1}/{num_chunks}:\n{text}" for i, text in enumerate(all_texts))
-    except Exception as e:
-        logger.error(f"Ошибка обработки большого файла: {e}")
-        raise
+                with open(path, encoding="utf-8") as f:
+                    self._templates.update(json.load(f))
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить шаблоны имен файлов: {e}")
 
-async def extract_audio_from_video(video_path: str) -> str:
-    """Извлекает аудио из видео в MP3 формат"""
-    audio_path = os.path.join(tempfile.gettempdir(), f"audio_{uuid.uuid4().hex}.mp3")
-    try:
-        video = AudioSegment.from_file(video_path)
-        video.set_channels(1).set_frame_rate(16000).export(
-            audio_path,
-            format="mp3",
-            bitrate="64k"
-        )
-        return audio_path
-    except Exception as e:
-        logger.error(f"Ошибка извлечения аудио: {e}")
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-        return None
+    def _remember(self, shape: str, spans: dict):
+        self._templates[shape] = spans
+        self._templates.move_to_end(shape)
+        while len(self._templates) > self.cache_size:
+            self._templates.popitem(last=False)
+        if self.path:
+            try:
+                with open(self.path, "w", encoding="utf-8") as f:
+                    json.dump(self._templates, f, ensure_ascii=False)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить шаблоны имен файлов: {e}")
 
-async def process_audio_file(file_path: str, file_name: str, message: types.Message, state: FSMContext) -> int:
-    """Обрабатывает аудиофайл и возвращает номер строки в Google Sheets"""
-    try:
-        audio = AudioSegment.from_file(file_path)
-        file_size = os.path.getsize(file_path)
-        file_len = round(len(audio) / 1000)  
-        if file_size <= MAX_FILE_SIZE:
-            with open(file_path, "rb") as audio_file:
-                transcript = client.audio.transcriptions.create(
-                    file=audio_file,
-                    model="whisper-1",
-                    language="ru"
-                )
-            transcription_text = transcript.text
-        else:
-            
-            transcription_text = await process_large_audio(file_path)
-        
-        state_data = await state.get_data()
-        assistant_id = state_data.get('ass_token')
-        
-        thread = client.beta.threads.create()
-        client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=transcription_text
-        )
-        
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=assistant_id
-        )
-        
-        while True:
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread.id,
-                run_id=run.id
-            )
-            if run_status.status == "completed":
-                break
-            await asyncio.sleep(1)
-        
-        messages = client.beta.threads.messages.list(thread_id=thread.id)
-        response_text = messages.data[0].content[0].text.value
-        
-        username = message.from_user.username or str(message.from_user.id)
-        
-        return await write_to_google_sheets(
-            transcription_text=transcription_text,
-            ai_response=response_text,
-            file_name=file_name,
-            username=username,
-            state=state,
-            sheet_n=1,
-            file_len=str(file_len)
-        )
-    except Exception as e:
-        logger.error(f"Ошибка обработки файла: {e}")
-        raise
+    async def parse(self, file_name: str) -> Tuple[str, str, str, str]:
+        """Возвращает (день, месяц, год, телефон), недостающие поля заполняются Empty"""
+        parsed = parse_file_name(file_name)
+        if parsed:
+            return parsed
 
-async def process_folder(folder_url: str, message: types.Message, state: FSMContext):
-    """Обрабатывает все аудиофайлы в указанной папке с параллельным выполнением"""
-    folder_id = extract_file_id_from_url(folder_url)
-    if not folder_id:
-        await message.reply("❌ Не удалось определить ID папки из ссылки")
-        return False
-    
-    try:
-        files = await list_files_in_folder(folder_id)
-        if not files:
-            await message.reply("🔍 В папке не найдено аудиофайлов")
-            return False
-        
-        
-        await state.update_data(current_folder=folder_id, files_to_process=files)
-        
-        total_files = len(files)
-        await message.reply(f"🔍 Найдено {total_files} файлов. Начинаю обработку...")
-
-        # Создаем семафор для ограничения одновременных задач (3-5 в зависимости от сервера)
-        concurrency_limit = asyncio.Semaphore(10)
-        results = []
-
-        async def process_single_file_wrapper(file: dict):
-            async with concurrency_limit:
-                file_id = file['id']
-                file_name = file['name']
-                input_path = f"temp_{uuid.uuid4().hex}_{file_name}"
-                
-                try:
-                    # Скачивание
-                    if not await download_from_google_drive(file_id, input_path):
-                        return f"❌ {file_name} - ошибка скачивания"
-                    audio = AudioSegment.from_file(input_path)
-                    if len(audio) < 3000:
-                        return f"⚠️ {file_name} - слишком короткое аудио (меньше 3 сек)"
-                    # Если это видео - извлекаем аудио
-                    if file['mimeType'].startswith('video/'):
-                        audio_path = await extract_audio_from_video(input_path)
-                        if not audio_path:
-                            return f"❌ {file_name} - ошибка извлечения аудио"
-                        processing_path = audio_path
-                    else:
-                        # Для аудио - конвертируем в MP3 если нужно
-                        processing_path = await convert_audio(input_path) if not input_path.endswith('.mp3') else input_path
-                        if not processing_path:
-                            return f"❌ {file_name} - ошибка конвертации"
-
-                    # Обработка
-                    row_number = await process_audio_file(processing_path, file_name, message, state)
-                    return f"✅ {file_name} - строка {row_number}"
+        shape = _file_name_shape(file_name)
+        # None встречается в файлах шаблонов старых версий: такую форму снова спрашиваем у LLM
+        if self._templates.get(shape) is not None:
+            self._templates.move_to_end(shape)
+            return _apply_template(file_name, self._templates[shape])
 
-                except Exception as e:
-                    logging.error(f"Ошибка обработки {file_name}: {e}")
-                    
-                    return f"❌ {file_name} - ошибка: {str(e)}"
-                finally:
-                    # Удаляем все временные файлы
-                    for path in [input_path, processing_path if 'processing_path' in locals() else None]:
-                        if path and os.path.exists(path) and path != input_path:
-                            try:
-                                os.remove(path)
-                            except:
-                                pass
-
-        # Запускаем все задачи параллельно
-        tasks = [process_single_file_wrapper(file) for file in files]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        # Анализ результатов
-        successful = sum(1 for r in results if isinstance(r, str) and r.startswith("✅"))
-        failed = len(results) - successful
-
-        # Формируем отчет
-        report = [
-            f"📊 Итоговый отчет:",
-            f"Всего файлов: {total_files}",
-            f"Успешно обработано: {successful}",
-            f"Не удалось обработать: {failed}",
-            "",
-            "Результаты по файлам:"
-        ]
+        promt = f"Твоя задача проанализировать название файла и написать ответ строго в заданном формате, если данных недостаточно вместо отсутствующих данных напиши Empty, сохраняя формат сообщения. Дополнительно для выдачи номера телефона используй следующие данные: Номер телефона всегда должен начинатся на +7 (если в названии файла это 8 или 7 замени на +7). Формат для выдачи номера телефона: +7 999 999-99-99  Название файла для анализа{file_name} Ответ дай строго в формате: День/Месяц/Год/Номер телефона"
+        raw_response = await get_chatgpt_response(promt)
+        parts = [part.strip() for part in raw_response.strip().split('/')]
+        if len(parts) != 4:
+            logger.warning(f"LLM вернул ответ не в формате для {file_name}: {raw_response}")
+            return (EMPTY_FIELD,) * 4
+        fields = tuple(parts)
+        spans = _learn_template(file_name, fields)
+        if spans is not None:
+            # Неудачу не запоминаем, иначе имена этой формы больше не дошли бы до LLM
+            self._remember(shape, spans)
+        return fields
 
-        # Разбиваем результаты на части для отправки
-        chunk_size = 40
-        for i in range(0, len(results), chunk_size):
-            chunk = results[i:i + chunk_size]
-            report_chunk = "\n".join([*report[:5], *chunk]) if i == 0 else "\n".join(chunk)
-            await message.reply(report_chunk)
 
-        return True
+file_name_parser = FileNameParser()
 
-    except Exception as e:
-        logger.error(f"Ошибка при обработке папки: {e}")
-        await message.reply(f"❌ Произошла критическая ошибка при обработке папки: {e}")
-        return False
+# Писатель в Google Sheets
+class SheetsWriter:
+    """Кэширует авторизованного клиента и листы, копит строки и дописывает их пачками через append_rows"""
+
+    def __init__(self, flush_interval: float = SHEETS_FLUSH_INTERVAL, batch_size: int = SHEETS_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._gc = None
+        self._worksheets = {}
+        self._cache_lock = threading.Lock()
+        self._pending = {}
+        self._flush_tasks = {}
+
+    def _get_worksheet(self, spreadsheet_id: str, sheet_name: str):
+        """Возвращает лист из кэша, при первом обращении авторизуется и открывает таблицу"""
+        with self._cache_lock:
+            key = (spreadsheet_id, sheet_name)
+            if key not in self._worksheets:
+                if self._gc is None:
+                    scope = ['https://www.googleapis.com/auth/spreadsheets',
+                             'https://www.googleapis.com/auth/drive']
+                    creds = ServiceAccountCredentials.from_json_keyfile_dict(GOOGLE_DRIVE_CREDS, scope)
+                    self._gc = gspread.authorize(creds)
+                self._worksheets[key] = self._gc.open_by_key(spreadsheet_id).worksheet(sheet_name)
+            return self._worksheets[key]
+
+    def _append_rows(self, key: tuple, rows: list) -> int:
+        """Дописывает строки и возвращает номер первой из них по updatedRange ответа"""
+        worksheet = self._get_worksheet(*key)
+        response = worksheet.append_rows(rows, value_input_option="RAW")
+        updated_range = response["updates"]["updatedRange"]  # Например 'Sheet1'!A120:M122
+        cells = updated_range.split("!")[-1].split(":")[0]
+        return int(cells.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ$"))
+
+    async def append(self, spreadsheet_id: str, sheet_name: str, row: list) -> int:
+        """Ставит строку в очередь на запись и возвращает номер строки после записи пачки"""
+        key = (spreadsheet_id, sheet_name)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append((row, future))
+        if key not in self._flush_tasks:
+            self._flush_tasks[key] = asyncio.create_task(self._flush_loop(key))
+        return await future
+
+    async def _flush_loop(self, key: tuple):
+        try:
+            while self._pending.get(key):
+                await asyncio.sleep(self.flush_interval)
+                batch = self._pending[key][:self.batch_size]
+                self._pending[key] = self._pending[key][self.batch_size:]
+                try:
+                    # Повтор после обрыва мог бы задвоить строки, поэтому повторяем только отказы по квоте
+                    first_row = await sheets_limiter.call(
+                        lambda: asyncio.to_thread(self._append_rows, key, [row for row, _ in batch]),
+                        idempotent=False
+                    )
+                except Exception as e:
+                    # Сбрасываем кэш листа: таблицу могли удалить или переименовать
+                    with self._cache_lock:
+                        self._worksheets.pop(key, None)
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for i, (_, future) in enumerate(batch):
+                    if not future.done():
+                        future.set_result(first_row + i)
+        finally:
+            self._pending.pop(key, None)
+            self._flush_tasks.pop(key, None)
+
+
+sheets_writer = SheetsWriter()
 
 # Функция записи в Google Sheets
-async def write_to_google_sheets(transcription_text: str, ai_response: str, file_name: str, username: str, sheet_n: int, file_len: str, state: FSMContext) -> int:
+async def write_to_google_sheets(transcription_text: str, ai_response: str, file_name: str, username: str, sheet_n: int, file_len: str, user_data: dict) -> int:
     """Записывает данные в Google Sheets и возвращает номер строки"""
     try:
-        user_data = await state.get_data()
-        
-        scope = ['https://www.googleapis.com/auth/spreadsheets',
-               'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(GOOGLE_DRIVE_CREDS, scope)
-        gc = gspread.authorize(creds)
         if sheet_n == 1:
-            spreadsheet = gc.open_by_key(os.getenv("GSHEETS_SPREADSHEET_ID"))
+            spreadsheet_id = os.getenv("GSHEETS_SPREADSHEET_ID")
         else:
-            spreadsheet = gc.open_by_key(user_data.get("sheet_id_token"))
-        worksheet = spreadsheet.worksheet(os.getenv("GSHEETS_SHEET_NAME", "Sheet1"))
+            spreadsheet_id = user_data.get("sheet_id_token")
+        sheet_name = os.getenv("GSHEETS_SHEET_NAME", "Sheet1")
 
-        promt = f"Твоя задача проанализировать название файла и написать ответ строго в заданном формате, если данных недостаточно вместо отсутствующих данных напиши Empty, сохраняя формат сообщения. Дополнительно для выдачи номера телефона используй следующие данные: Номер телефона всегда должен начинатся на +7 (если в названии файла это 8 или 7 замени на +7). Формат для выдачи номера телефона: +7 999 999-99-99  Название файла для анализа{file_name} Ответ дай строго в формате: День/Месяц/Год/Номер телефона"
-        raw_response = await get_chatgpt_response(promt)
-        print(raw_response)
-        day, month, year, phone = raw_response.split('/')
+        day, month, year, phone = await file_name_parser.parse(file_name)
 
 
         row_data = [
@@ -535,8 +3113,8 @@ async def write_to_google_sheets(transcription_text: str, ai_response: str, file
             year
         ]
 
-        worksheet.append_row(row_data)
-        return len(worksheet.col_values(1))
+        async with track_stage("sheets"):
+            return await sheets_writer.append(spreadsheet_id, sheet_name, row_data)
     
     except Exception as e:
         logger.error(f"Ошибка записи в Google Sheets: {str(e)}")
@@ -554,6 +3132,35 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
                 f"Message: {message.text}"
             )
 
+@router.message(Command("watch"))
+async def watch_folder_handler(message: Message, command: CommandObject, state: FSMContext):
+    """/watch <ссылка на папку> - обрабатывать новые файлы папки по расписанию; без ссылки - список папок"""
+    logger.info(f"User {message.from_user.id} sent message {message.text}")
+    chat = await ChatContext.from_message(message, state)
+    if not command.args:
+        await dispatch_task({"kind": "watches", "chat": asdict(chat)})
+        return
+    if not (await state.get_data()).get('ass_token'):
+        await message.reply("Сначала пройдите настройку: /start")
+        return
+    folder_id = extract_file_id_from_url(command.args.strip()) if '/folders/' in command.args else None
+    if not folder_id:
+        await message.reply("❌ Пришлите ссылку на папку Google Drive: /watch https://drive.google.com/drive/folders/...")
+        return
+    await dispatch_task({"kind": "watch", "folder_id": folder_id, "chat": asdict(chat)})
+
+
+@router.message(Command("unwatch"))
+async def unwatch_folder_handler(message: Message, command: CommandObject, state: FSMContext):
+    logger.info(f"User {message.from_user.id} sent message {message.text}")
+    folder_id = extract_file_id_from_url(command.args.strip()) if command.args else None
+    if not folder_id:
+        await message.reply("❌ Эта папка не отслеживается. Список папок: /watch")
+        return
+    chat = await ChatContext.from_message(message, state)
+    await dispatch_task({"kind": "unwatch", "folder_id": folder_id, "chat": asdict(chat)})
+
+
 @router.message(StateFilter(UserState.ass_token))
 async def company_name(message: Message, state: FSMContext):
     logger.info(f"User {message.from_user.id} sent message {message.text}")
@@ -614,42 +3221,84 @@ async def handle_audio_link(message: types.Message, state: FSMContext):
         await message.reply("❌ Пожалуйста, отправьте ссылку на Google Drive")
         return
     
+    chat = await ChatContext.from_message(message, state)
     if 'folder' in url or '/folders/' in url:
-        await process_folder(url, message, state)
+        folder_id = extract_file_id_from_url(url)
+        if not folder_id:
+            await message.reply("❌ Не удалось определить ID папки из ссылки")
+            return
+        await state.update_data(current_folder=folder_id)
+        await dispatch_task({"kind": "folder", "folder_id": folder_id, "chat": asdict(chat)})
         return
     
     file_id = extract_file_id_from_url(url)
     if not file_id:
         await message.reply("❌ Не удалось извлечь ID файла")
         return
-    
+
+    await dispatch_task({"kind": "drive_link", "file_id": file_id, "chat": asdict(chat)})
+
+
+async def process_drive_link(file_id: str, chat: "ChatContext"):
+    """Скачивает и обрабатывает один файл по ссылке Google Drive"""
     temp_path = f"temp_{uuid.uuid4().hex}"
+    job_trace_id.set(f"drive/{file_id}")
+    source = prepared = None
     try:
+        try:
+            metadata = await get_drive_file_metadata(file_id)
+        except Exception as e:
+            logger.warning(f"Не удалось получить метаданные {file_id}: {e}")
+            metadata = {'id': file_id}
+        cache_keys = drive_cache_keys(metadata)
+        size = int(metadata.get('size') or 0)
+        cached = await transcript_cache.get(cache_keys, count_miss=False)
+        if cached:
+            row_number = await process_transcription(*cached, "Аудиофайл", chat)
+            await chat.reply(f"✅ Результат записан в строку {row_number}")
+            return
+
+        admission = await admit_drive_file(file_id, size or None, drive_duration(metadata))
+        if not admission.accepted:
+            await chat.reply(f"❌ {admission.reason}")
+            return
+
         # Скачивание
-        await message.reply("⏳ Скачиваю файл...")
-        if not await download_from_google_drive(file_id, temp_path):
-            await message.reply("❌ Ошибка скачивания")
+        await chat.reply("⏳ Скачиваю файл...")
+        # Небольшие файлы не пишем на диск, а подаем в ffmpeg через stdin; файлы под нарезку - всегда на диск
+        destination = bytearray() if 0 < size <= STREAM_SPILL_BYTES and not admission.chunked else temp_path
+        if not await download_from_google_drive(file_id, destination, size or None):
+            await chat.reply("❌ Ошибка скачивания")
             return
 
-        # Определяем тип файла
-        is_video = any(temp_path.endswith(ext) for ext in ['.mp4', '.mov', '.avi'])
+        # Определяем тип файла по потокам, а не по расширению
+        if isinstance(destination, bytearray):
+            source = await load_media(bytes(destination), temp_path)
+        else:
+            source = await probe_media(temp_path)
+        is_video = source.has_video
+
+        content_key = await content_cache_key(source)
+        cached = await transcript_cache.get([content_key])
+        if cached:
+            await transcript_cache.put(cache_keys, *cached)
+            row_number = await process_transcription(*cached, "Видеофайл" if is_video else "Аудиофайл", chat)
+            await chat.reply(f"✅ Результат записан в строку {row_number}")
+            return
         
         # Обработка
-        await message.reply("🔍 Извлекаю аудио..." if is_video else "🔍 Обрабатываю аудио...")
-        audio_path = await extract_audio_from_video(temp_path) if is_video else await convert_audio(temp_path)
-        
-        if not audio_path:
-            await message.reply("❌ Ошибка обработки аудио")
+        await chat.reply("🔍 Извлекаю аудио..." if is_video else "🔍 Обрабатываю аудио...")
+        try:
+            prepared = await prepare_audio(source)
+        except Exception:
+            await chat.reply("❌ Ошибка обработки аудио")
             return
             
-        row_number = await process_audio_file(audio_path, "Видеофайл" if is_video else "Аудиофайл", message, state)
-        await message.reply(f"✅ Результат записан в строку {row_number}")
-        
-    except Exception as e:
-        logger.error(f"Ошибка: {e}")
-        await message.reply(f"❌ Ошибка: {str(e)}")
+        row_number = await process_audio_file(prepared, "Видеофайл" if is_video else "Аудиофайл", chat, cache_keys + [content_key])
+        await chat.reply(f"✅ Результат записан в строку {row_number}")
+        # Прочие ошибки уходят вызывающему: воркер повторит задачу или сообщит о сбое
     finally:
-        for path in [temp_path, audio_path if 'audio_path' in locals() else None]:
+        for path in [temp_path, source.path if source else None, prepared.path if prepared else None]:
             if path and os.path.exists(path):
                 try: os.remove(path)
                 except: pass
@@ -657,113 +3306,265 @@ async def handle_audio_link(message: types.Message, state: FSMContext):
 
 
 
+def describe_tg_media(message: types.Message) -> Optional[dict]:
+    """Файл из сообщения для задачи tg_file; None, если в сообщении нет аудио или видео"""
+    if message.voice:
+        media, ext, file_name = message.voice, "ogg", "Голосовое сообщение"
+    elif message.audio:
+        media, ext, file_name = message.audio, "mp3", message.audio.file_name or "Аудиофайл"
+    elif message.video:
+        media, ext, file_name = message.video, "mp4", message.video.file_name or "Видеофайл"
+    elif message.document and (message.document.mime_type or "").startswith('audio/'):
+        media = message.document
+        file_name = message.document.file_name or "Аудиофайл"
+        ext = os.path.splitext(file_name)[1][1:] or "mp3"
+    else:
+        return None
+    return {
+        "file_id": media.file_id,
+        "file_unique_id": media.file_unique_id,
+        "ext": ext,
+        "file_name": file_name,
+        # У документов длительности нет, 0 - отправитель ее не указал; такие проверит ffprobe
+        "duration": getattr(media, "duration", None) or None,
+        "file_size": media.file_size,
+    }
+
+
 @router.message(F.voice | F.audio | F.document | F.video | F.media_group_id.is_not(None), StateFilter(UserState.audio))
-async def handle_tg_audio(message: types.Message, state: FSMContext):
+async def handle_tg_audio(message: types.Message, state: FSMContext, album: Optional[List[types.Message]] = None):
     logger.info(f"User {message.from_user.id} sent message {message.text}")
-    # Проверяем, не обрабатывалась ли уже эта медиагруппа
-    if message.media_group_id:
-        async with state.proxy() as data:
-            processed_groups = data.setdefault("processed_media_groups", set())
-            if message.media_group_id in processed_groups:
-                return
-            processed_groups.add(message.media_group_id)
-    
-    concurrency_limit = asyncio.Semaphore(10)
-    async with concurrency_limit:
-        unique_id = uuid.uuid4().hex
-        input_path = None
-        output_path = None
-        
+    # Альбом приходит сюда один раз целиком, его собирает AlbumMiddleware
+    messages = album or [message]
+    media = [item for item in map(describe_tg_media, messages) if item]
+    if not media:
+        await message.reply("❌ Пожалуйста, отправьте аудиофайл")
+        return
+
+    # Размер и длительность известны из самого сообщения: заведомо неподходящие файлы даже не скачиваем
+    files, rejected = [], []
+    for item in media:
+        admission = admit_media(item['file_size'], item['duration'], TELEGRAM_FILE_LIMIT)
+        ADMISSION_DECISIONS.labels("telegram", admission.decision).inc()
+        if admission.accepted:
+            files.append(item)
+        else:
+            rejected.append((item, admission.reason))
+    if len(messages) == 1 and rejected:
+        item, reason = rejected[0]
+        too_big = item['file_size'] and item['file_size'] > TELEGRAM_FILE_LIMIT
+        hint = " Пожалуйста, загрузите его в сжатом виде или пришлите ссылку на Google Drive." if too_big else ""
+        await message.reply(f"❌ {reason}.{hint}")
+        return
+    if len(media) < len(messages) or rejected:
+        lines = [f"⚠️ Файлов без аудио: {len(messages) - len(media)}"] if len(media) < len(messages) else []
+        lines += [f"❌ {item['file_name']}: {reason}" for item, reason in rejected]
+        await message.reply("В альбоме пропущены:\n" + "\n".join(lines))
+    if not files:
+        return
+
+    chat = await ChatContext.from_message(message, state)
+    if len(messages) == 1:
+        await dispatch_task({"kind": "tg_file", **files[0], "chat": asdict(chat)})
+        return
+    await dispatch_task({"kind": "tg_album", "files": files, "chat": asdict(chat)})
+
+
+class FileRejected(Exception):
+    """Файл не подлежит обработке; текст исключения показывается пользователю"""
+
+
+async def transcribe_tg_media(file_id: str, file_unique_id: str, ext: str, duration: Optional[float] = None) -> Tuple[str, float]:
+    """Скачивает файл из Telegram и возвращает транскрипцию и длительность, повторы берет из кэша.
+
+    duration - длительность из сообщения; у документов ее нет, тогда крупный файл
+    до скачивания проверяется ffprobe по заголовку.
+    """
+    unique_id = uuid.uuid4().hex
+    input_path = f"temp_{unique_id}.{ext}"
+    source = prepared = None
+    # Повторно присланный файл не скачиваем и не транскрибируем
+    cache_keys = [f"tg:{file_unique_id}"]
+    cached = await transcript_cache.get(cache_keys, count_miss=False)
+    if cached:
+        return cached
+
+    local_path = None
+    try:
         try:
-            # Определение типа файла
-            try:
-                if message.voice:
-                    file = await bot.get_file(message.voice.file_id)
-                    ext = "ogg"
-                    file_name = "Голосовое сообщение"
-                elif message.audio:
-                    file = await bot.get_file(message.audio.file_id)
-                    ext = "mp3"
-                    file_name = message.audio.file_name or "Аудиофайл"
-                elif message.video:
-                    file = await bot.get_file(message.video.file_id)
-                    ext = "mp4"
-                    file_name = message.video.file_name or "Видеофайл"
-                else:
-                    if not message.document.mime_type.startswith('audio/'):
-                        await message.reply("❌ Пожалуйста, отправьте аудиофайл")
-                        return
-                    file = await bot.get_file(message.document.file_id)
-                    ext = os.path.splitext(message.document.file_name)[1][1:] or "mp3"
-                    file_name = message.document.file_name
-            except TelegramBadRequest as e:
-                if "file is too big" in str(e):
-                    await message.reply("📁 Файл слишком большой для автоматической обработки. "
-                                      "Пожалуйста, загрузите его в сжатом виде (меньше 20 МБ) "
-                                      "или используйте ссылку на файл.")
-                    return
-                raise
-            
-            input_path = f"temp_{unique_id}.{ext}"
-            
-            # Скачивание с обработкой ошибок
+            file = await bot.get_file(file_id)
+        except TelegramBadRequest as e:
+            if "file is too big" in str(e):
+                raise FileRejected(f"Файл больше {TELEGRAM_FILE_LIMIT // 1024 // 1024} МБ, Telegram не дает его скачать. "
+                                   "Пожалуйста, загрузите его в сжатом виде "
+                                   "или используйте ссылку на файл в Google Drive.")
+            raise
+
+        local_path = telegram_downloader.local_path(file)
+        admission = admit_media(file.file_size, duration, TELEGRAM_FILE_LIMIT)
+        if local_path is None and duration is None and (file.file_size or 0) > ADMISSION_PROBE_MIN_BYTES:
+            probed = await probe_remote_duration(bot.session.api.file_url(bot.token, file.file_path))
+            if probed is not None:
+                admission = admit_media(file.file_size, probed, TELEGRAM_FILE_LIMIT)
+                ADMISSION_DECISIONS.labels("telegram_probe", admission.decision).inc()
+        if not admission.accepted:
+            raise FileRejected(admission.reason)
+        buffer = None
+        if local_path is None:
+            # Небольшие файлы скачиваем в память и подаем в ffmpeg через stdin; файлы под нарезку - на диск
+            buffer = io.BytesIO() if file.file_size and file.file_size <= STREAM_SPILL_BYTES and not admission.chunked else None
             try:
-                if not await safe_download_file(file, input_path):
-                    await message.reply("❌ Не удалось скачать файл после нескольких попыток")
-                    return
+                await safe_download_file(file, buffer if buffer is not None else input_path)
             except Exception as e:
                 logger.error(f"Ошибка скачивания файла {input_path}: {e}")
-                await message.reply(f"❌ Ошибка скачивания файла: {str(e)}")
-                return
-            
-            try:
-                # Определяем тип файла
-                is_video = any(input_path.endswith(ext) for ext in ['.mp4', '.mov', '.avi'])
-            
-                if is_video:
-                    audio_path = await extract_audio_from_video(input_path)  
-                    input_path = audio_path
-            except Exception as e:
-                await message.reply(f"❌ Ошибка извлечения: {str(e)}")
-                return
-            
-            # Проверка размера файла
-            if os.path.getsize(input_path) > 100 * 1024 * 1024:
-                os.remove(input_path)
-                await message.reply("❌ Файл слишком большой. Максимальный размер: 100MB")
-                return
+                raise RuntimeError(f"ошибка скачивания файла: {e}")
 
-            if ext != "mp3":
-                output_path = await convert_audio(input_path)
-                if not output_path:
-                    await message.reply("❌ Ошибка конвертации аудио")
-                    return
+        try:
+            if local_path:
+                # Файл уже на диске локального Bot API: ffmpeg читает его на месте, без копирования
+                source = await probe_media(local_path)
+            elif buffer is not None:
+                source = await load_media(buffer.getvalue(), input_path)
             else:
-                output_path = input_path
+                source = await probe_media(input_path)
+        except Exception as e:
+            raise RuntimeError(f"ошибка извлечения: {e}")
 
-            audio = AudioSegment.from_file(output_path)
-            duration_ms = len(audio)
-            if duration_ms < 3000:  # 3 секунды = 3000 мс
-                await message.reply("❌ Слишком короткое аудио (меньше 3 секунд)")
-                return
-                
-            try:
-                row_number = await process_audio_file(output_path, file_name, message, state)
-                await message.reply(f"✅ Результат записан в строку {row_number}")            
-            except Exception as e:
-                await message.reply(f"❌ Ошибка обработки: {str(e)}")
-                
+        # Проверка размера файла
+        if source.size > TELEGRAM_FILE_LIMIT:
+            raise FileRejected(f"Файл слишком большой. Максимальный размер: {TELEGRAM_FILE_LIMIT // 1024 // 1024} МБ")
+        if source.duration < MIN_AUDIO_DURATION:
+            raise FileRejected("Слишком короткое аудио (меньше 3 секунд)")
+
+        content_key = await content_cache_key(source)
+        cached = await transcript_cache.get([content_key])
+        if cached:
+            await transcript_cache.put(cache_keys, *cached)
+            return cached
+
+        try:
+            prepared = await prepare_audio(source)
+        except Exception:
+            raise RuntimeError("ошибка конвертации аудио")
+        transcription = await transcribe_prepared(prepared)
+        await transcript_cache.put(cache_keys + [content_key], transcription, prepared.source_duration)
+        return transcription, prepared.source_duration
+    finally:
+        # Гарантированная очистка временных файлов; файлы Bot API сервера не трогаем
+        for path in [input_path, source.path if source else None, prepared.path if prepared else None]:
+            if path and path != local_path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except Exception as e:
+                    logger.error(f"Ошибка удаления файла {path}: {e}")
+
+
+async def process_tg_media(file_id: str, file_unique_id: str, ext: str, file_name: str, chat: "ChatContext", duration: Optional[float] = None):
+    """Скачивает и обрабатывает файл, присланный в Telegram"""
+    job_trace_id.set(f"tg/{uuid.uuid4().hex[:12]}")
+    try:
+        transcription, duration = await transcribe_tg_media(file_id, file_unique_id, ext, duration)
+        row_number = await process_transcription(transcription, duration, file_name, chat)
+        await chat.reply(f"✅ Результат записан в строку {row_number}")
+    except FileRejected as e:
+        await chat.reply(f"❌ {e}")
+
+
+async def process_tg_album(files: List[dict], chat: "ChatContext"):
+    """Альбом из Telegram одним заданием: файлы в общей очереди, один статус и одна пачка строк в таблицу"""
+    album_id = uuid.uuid4().hex
+    results = [
+        {"file_id": item['file_id'], "name": item['file_name'], "status": "pending", "row_number": None, "duration": None, "error": None}
+        for item in files
+    ]
+    job = {"id": album_id, "chat_id": chat.chat_id, "message_id": chat.message_id, "listed": True}
+    progress = FolderProgress(job, results, title="📎 Обработка альбома")
+    await progress.start()
+
+    async def analyze(item: dict, result: dict) -> Optional[Tuple[str, str]]:
+        job_trace_id.set(f"album/{album_id[:8]}/{item['file_unique_id']}")
+        try:
+            transcription, result['duration'] = await transcribe_tg_media(item['file_id'], item['file_unique_id'], item['ext'], item.get('duration'))
+            return transcription, await analyze_transcription(transcription, chat.user_data.get('ass_token'))
+        except FileRejected as e:
+            result.update(status="skipped", error=str(e))
         except Exception as e:
-            logger.exception(f"Ошибка в handle_audio: {e}")
-            await message.reply("❌ Произошла ошибка при обработке файла")
-        finally:
-            # Гарантированная очистка временных файлов
-            for path in [input_path, output_path]:
-                if path and os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except Exception as e:
-                        logger.error(f"Ошибка удаления файла {path}: {e}")
+            logger.error(f"Ошибка обработки {item['file_name']} из альбома: {e}")
+            result.update(status="failed", error=str(e))
+        progress.file_done(result)
+        return None
+
+    async def write(result: dict, transcription: str, ai_response: str):
+        try:
+            result['row_number'] = await write_to_google_sheets(
+                transcription_text=transcription,
+                ai_response=ai_response,
+                file_name=result['name'],
+                username=chat.username,
+                user_data=chat.user_data,
+                sheet_n=1,
+                file_len=str(round(result['duration']))
+            )
+            result['status'] = "written"
+        except Exception as e:
+            result.update(status="failed", error=str(e))
+        progress.file_done(result)
+
+    outputs = await asyncio.gather(*(
+        scheduler.submit(chat.user_id, lambda item=item, result=result: analyze(item, result))
+        for item, result in zip(files, results)
+    ), return_exceptions=True)
+    # Строки пишутся одновременно, поэтому SheetsWriter отправляет их одним append_rows
+    await asyncio.gather(*(
+        write(result, *output) for result, output in zip(results, outputs) if isinstance(output, tuple)
+    ))
+    await progress.finish(results)
+
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", "queue": scheduler.pending})
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+def add_service_routes(app: web.Application):
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics)
+
+
+async def start_metrics_server() -> web.AppRunner:
+    """Отдельный сервер /metrics и /healthz для режима polling и воркеров"""
+    app = web.Application()
+    add_service_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на {WEBAPP_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+async def run_webhook():
+    """Принимает обновления через вебхук: Telegram сразу получает 200, обработка идет в фоне"""
+    app = web.Application()
+    add_service_routes(app)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    await bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logger.info(f"Вебхук слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main() -> None:
@@ -774,7 +3575,31 @@ async def main() -> None:
     )
     dp.include_router(router)
     dp.message.middleware(StateMiddleware())
-    await dp.start_polling(bot)
+    dp.message.middleware(AlbumMiddleware())
+    watcher = None
+    if PROCESS_ROLE != "bot":
+        await resume_folder_jobs()
+        watcher = asyncio.create_task(run_folder_watcher())
+    metrics_runner = None
+    if METRICS_PORT and (PROCESS_ROLE == "worker" or BOT_MODE != "webhook"):
+        metrics_runner = await start_metrics_server()
+    try:
+        if PROCESS_ROLE == "worker":
+            await run_task_consumer()
+        elif BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Иначе getUpdates конфликтует с вебхуком, оставшимся от запуска в другом режиме
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if watcher:
+            watcher.cancel()
+        await drive_downloader.close()
+        await telegram_downloader.close()
+        await probe_proxy.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""Размыкание цепи: состояние меняет только ответ на пробный запрос.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GS_PRIVATE_KEY", "")
+os.environ.setdefault("JOBS_DIR", tempfile.mkdtemp())
+
+import main  # noqa: E402
+
+
+def open_breaker() -> main.CircuitBreaker:
+    breaker = main.CircuitBreaker("test", threshold=2, cooldown=10)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_threshold():
+    async def scenario():
+        breaker = open_breaker()
+        assert breaker._half_open
+        assert breaker.cooldown == 10
+    asyncio.run(scenario())
+
+
+def test_late_results_do_not_change_open_breaker():
+    async def scenario():
+        breaker = open_breaker()
+        opened_until = breaker._open_until
+        # Ответы на запросы, начатые до размыкания
+        breaker.record_failure()
+        breaker.record_success()
+        assert breaker._half_open
+        assert breaker.cooldown == 10
+        assert breaker._open_until == opened_until
+    asyncio.run(scenario())
+
+
+def test_probe_success_closes():
+    async def scenario():
+        breaker = open_breaker()
+        breaker.record_success(probe=True)
+        assert not breaker._half_open
+        assert breaker._failures == 0
+    asyncio.run(scenario())
+
+
+def test_probe_failure_doubles_cooldown():
+    async def scenario():
+        breaker = open_breaker()
+        breaker.record_failure(probe=True)
+        assert breaker._half_open
+        assert breaker.cooldown == 20
+    asyncio.run(scenario())
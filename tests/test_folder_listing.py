@@ -0,0 +1,107 @@
+"""Обход папки Google Drive на подставном сервисе files().list.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GS_PRIVATE_KEY", "")
+os.environ.setdefault("JOBS_DIR", tempfile.mkdtemp())
+
+import main  # noqa: E402
+
+
+class FakeDrive:
+    """files().list по словарю папка -> содержимое; None - папку прочитать нельзя"""
+
+    def __init__(self, tree: dict):
+        self.tree = tree
+
+    def files(self):
+        return self
+
+    def list(self, q: str, **kwargs):
+        folder_id = q.split("'")[1]
+        items = self.tree[folder_id]
+
+        class Request:
+            def execute(_):
+                if items is None:
+                    raise RuntimeError(f"403 для {folder_id}")
+                return {'files': items}
+        return Request()
+
+
+def folder(folder_id: str) -> dict:
+    return {'id': folder_id, 'name': folder_id, 'mimeType': main.DRIVE_FOLDER_MIME}
+
+
+def audio(file_id: str) -> dict:
+    return {'id': file_id, 'name': f"{file_id}.mp3", 'mimeType': "audio/mpeg"}
+
+
+def use_drive(monkeypatch, tree: dict):
+    async def service():
+        return FakeDrive(tree)
+    monkeypatch.setattr(main, "get_google_drive_service", service)
+
+
+async def collect(listing) -> list:
+    return [item['id'] async for item in listing]
+
+
+def test_walks_subfolders(monkeypatch):
+    use_drive(monkeypatch, {'root': [folder("sub"), audio("a")], 'sub': [audio("b")]})
+    assert sorted(asyncio.run(collect(main.iter_folder_files("root")))) == ["a", "b"]
+
+
+def test_failed_subfolder_is_reported_after_the_rest(monkeypatch):
+    use_drive(monkeypatch, {'root': [folder("sub"), audio("a")], 'sub': None})
+    found = []
+
+    async def scenario():
+        async for item in main.iter_folder_files("root"):
+            found.append(item['id'])
+
+    with pytest.raises(main.FolderListingError):
+        asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert found == ["a"]
+
+
+def test_service_error_does_not_hang(monkeypatch):
+    async def service():
+        raise RuntimeError("неверный ключ сервисного аккаунта")
+    monkeypatch.setattr(main, "get_google_drive_service", service)
+    with pytest.raises(RuntimeError):
+        asyncio.run(asyncio.wait_for(collect(main.iter_folder_files("root")), 5))
+
+
+def test_limit_counts_only_new_files(monkeypatch):
+    use_drive(monkeypatch, {'root': [audio(f"f{i}") for i in range(5)]})
+    processed = {"f0", "f1", "f2"}
+
+    async def skip(item):
+        return item['id'] in processed
+
+    listing = main.iter_folder_files("root", max_files=2, skip=skip)
+    assert asyncio.run(collect(listing)) == ["f3", "f4"]
+
+
+def test_truncated_listing_is_reported(monkeypatch):
+    use_drive(monkeypatch, {'root': [audio(f"f{i}") for i in range(5)]})
+    found = []
+
+    async def scenario():
+        async for item in main.iter_folder_files("root", max_files=3):
+            found.append(item['id'])
+
+    with pytest.raises(main.FolderListingError):
+        asyncio.run(scenario())
+    assert found == ["f0", "f1", "f2"]
@@ -0,0 +1,109 @@
+"""Задания по папкам на общем томе: кто из воркеров берет задание в работу.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GS_PRIVATE_KEY", "")
+os.environ.setdefault("JOBS_DIR", tempfile.mkdtemp())
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = main.JobStore(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(main, "job_store", main.ThreadedStore(store))
+    return store
+
+
+def create(store, job_id="job", queued=True):
+    return store.create_job(chat_id=1, message_id=2, folder_id="folder", username="user", user_data={}, job_id=job_id, queued=queued)
+
+
+def test_queued_job_is_created_once(store):
+    assert create(store) == create(store) == "job"
+    assert store.get_job("job")['status'] == "queued"
+
+
+def test_live_owner_keeps_job(store, monkeypatch):
+    create(store)
+    assert store.claim_job("job")
+    monkeypatch.setattr(main, "WORKER_ID", "other")
+    assert not store.claim_job("job")
+    assert store.unfinished_jobs() == []
+
+
+def test_expired_lease_is_claimed(store, monkeypatch):
+    create(store)
+    assert store.claim_job("job")
+    store._db.execute("UPDATE jobs SET lease_until = 0")
+    monkeypatch.setattr(main, "WORKER_ID", "other")
+    assert store.unfinished_jobs() == ["job"]
+    assert store.claim_job("job")
+    assert store.get_job("job")['owner'] == "other"
+
+
+def test_finished_job_is_not_claimed(store):
+    create(store)
+    store.finish_job("job")
+    assert not store.claim_job("job")
+
+
+def test_resume_skips_job_running_in_this_process(store, monkeypatch):
+    started = []
+
+    async def run_folder_job(job_id):
+        started.append(job_id)
+        return True
+
+    monkeypatch.setattr(main, "run_folder_job", run_folder_job)
+    create(store, queued=False)
+
+    async def scenario():
+        # Задача очереди уже взяла задание, периодическая проверка его не запускает
+        assert await main.claim_folder_job("job")
+        await main.resume_folder_jobs()
+        main.running_jobs.discard("job")
+        await main.resume_folder_jobs()
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert started == ["job"]
+
+
+def test_redelivered_folder_task_does_not_start_second_job(store, monkeypatch):
+    started = []
+
+    async def run_folder_job(job_id):
+        started.append(job_id)
+        return True
+
+    monkeypatch.setattr(main, "run_folder_job", run_folder_job)
+    chat = main.ChatContext(chat_id=1, message_id=2, user_id=3, username="user", user_data={})
+
+    async def scenario():
+        job_id = await main.create_folder_job("folder", chat)
+        assert await main.process_folder("folder", chat, job_id)
+        # Тот же воркер: задание уже идет в этом процессе
+        main.running_jobs.add(job_id)
+        try:
+            assert not await main.process_folder("folder", chat, job_id)
+        finally:
+            main.running_jobs.discard(job_id)
+        # Другой воркер, пока аренда владельца не истекла
+        monkeypatch.setattr(main, "WORKER_ID", "other")
+        assert not await main.process_folder("folder", chat, job_id)
+        return job_id
+
+    job_id = asyncio.run(scenario())
+    assert started == [job_id]
+    assert [row['id'] for row in store._db.execute("SELECT id FROM jobs")] == [job_id]
@@ -0,0 +1,218 @@
+"""Очередь задач между bot и worker: SQLite во временном файле и Redis на fakeredis.
+
+Запуск (нужны pytest и fakeredis, без fakeredis тесты Redis пропускаются):
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py читает их при импорте; к Telegram, OpenAI и таблицам тесты не обращаются
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GS_PRIVATE_KEY", "")
+os.environ.setdefault("JOBS_DIR", tempfile.mkdtemp())
+
+import main  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def sqlite_queue(tmp_path):
+    return lambda worker_id="w1", lease=60: main.SQLiteWorkQueue(str(tmp_path / "queue.db"), worker_id=worker_id, poll_interval=0.01, lease=lease)
+
+
+@pytest.fixture
+def redis_queue(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis.asyncio
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.asyncio, "from_url", lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs))
+    return lambda lease=60: main.RedisWorkQueue("redis://test", lease=lease)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_queue(request, sqlite_queue):
+    if request.param == "sqlite":
+        return lambda lease=60: sqlite_queue(lease=lease)
+    return lambda lease=60: request.getfixturevalue("redis_queue")(lease=lease)
+
+
+async def get_nowait(queue):
+    try:
+        return await asyncio.wait_for(queue.get(), 0.05)
+    except asyncio.TimeoutError:
+        return None
+
+
+def test_put_get_ack(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.put({'kind': "tg_file", 'n': 1})
+        await queue.put({'kind': "tg_file", 'n': 2})
+        first, first_receipt = await queue.get()
+        second, second_receipt = await queue.get()
+        assert (first['n'], second['n']) == (1, 2)
+        await queue.ack(first_receipt)
+        await queue.ack(second_receipt)
+        await queue.requeue_expired()
+        assert await get_nowait(queue) is None
+    run(scenario())
+
+
+def test_claimed_task_is_not_given_twice(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.put({'kind': "folder"})
+        await queue.get()
+        await queue.requeue_expired()
+        assert await get_nowait(queue) is None
+    run(scenario())
+
+
+def test_expired_lease_is_requeued(make_queue):
+    async def scenario():
+        queue = make_queue(lease=0.05)
+        await queue.put({'kind': "folder", 'folder_id': "abc"})
+        await queue.get()
+        # Воркер "упал": аренду никто не продлевает
+        await asyncio.sleep(0.1)
+        await queue.requeue_expired()
+        task, receipt = await get_nowait(queue)
+        assert task['folder_id'] == "abc"
+        await queue.ack(receipt)
+    run(scenario())
+
+
+def test_extended_lease_is_kept(make_queue):
+    async def scenario():
+        queue = make_queue(lease=0.5)
+        await queue.put({'kind': "folder"})
+        _, receipt = await queue.get()
+        await asyncio.sleep(0.3)
+        await queue.extend(receipt)
+        await asyncio.sleep(0.3)
+        await queue.requeue_expired()
+        assert await get_nowait(queue) is None
+    run(scenario())
+
+
+def test_retry_returns_task_with_attempts(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.put({'kind': "drive_link"})
+        task, receipt = await queue.get()
+        await queue.retry(receipt, {**task, 'attempts': 1})
+        task, receipt = await get_nowait(queue)
+        assert task['attempts'] == 1
+        await queue.ack(receipt)
+        assert await get_nowait(queue) is None
+    run(scenario())
+
+
+def test_sqlite_task_of_another_worker_after_restart(sqlite_queue):
+    async def scenario():
+        # Имя хоста после перезапуска контейнера другое: задачу возвращает истекшая аренда
+        old = sqlite_queue(worker_id="old-host", lease=0.05)
+        await old.put({'kind': "tg_file"})
+        await old.get()
+        await asyncio.sleep(0.1)
+        new = sqlite_queue(worker_id="new-host")
+        task, _ = await get_nowait(new)
+        assert task['kind'] == "tg_file"
+    run(scenario())
+
+
+def test_redis_task_claimed_without_lease_is_requeued(redis_queue):
+    async def scenario():
+        queue = redis_queue(lease=0.05)
+        await queue.put({'kind': "tg_file"})
+        # Воркер упал между BLMOVE и записью аренды
+        await queue._redis.lmove(queue.name, queue.processing, "RIGHT", "LEFT")
+        await queue.requeue_expired()
+        assert await get_nowait(queue) is None
+        await asyncio.sleep(0.1)
+        await queue.requeue_expired()
+        task, _ = await get_nowait(queue)
+        assert task['kind'] == "tg_file"
+    run(scenario())
+
+
+def test_consumer_retries_failed_task(monkeypatch, sqlite_queue):
+    queue = sqlite_queue()
+    calls = []
+
+    async def execute_task(task):
+        calls.append(task.get('attempts', 0))
+        raise RuntimeError("сбой")
+
+    monkeypatch.setattr(main, "work_queue", queue)
+    monkeypatch.setattr(main, "execute_task", execute_task)
+
+    async def scenario():
+        await queue.put({'kind': "tg_file"})
+        consumer = asyncio.create_task(main.run_task_consumer())
+        while len(calls) < main.TASK_MAX_ATTEMPTS:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        consumer.cancel()
+        assert calls == list(range(main.TASK_MAX_ATTEMPTS))
+        # После последней попытки задача снята с очереди
+        assert await get_nowait(queue) is None
+    run(asyncio.wait_for(scenario(), 5))
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "redis"])
+def test_fsm_storage_round_trip(backend, tmp_path):
+    from aiogram.fsm.storage.base import StorageKey
+    if backend == "sqlite":
+        storage = main.SQLiteStorage(str(tmp_path / "fsm.db"))
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        from aiogram.fsm.storage.redis import RedisStorage
+        storage = RedisStorage(redis=fakeredis.FakeAsyncRedis())
+    key = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+    async def scenario():
+        assert await storage.get_state(key) is None
+        await storage.set_state(key, "Form:name")
+        await storage.set_data(key, {'name': "Иван"})
+        assert await storage.get_state(key) == "Form:name"
+        assert await storage.get_data(key) == {'name': "Иван"}
+        await storage.close()
+    run(scenario())
+
+
+def test_watch_command_goes_through_queue(monkeypatch, sqlite_queue, tmp_path):
+    queue = sqlite_queue()
+    store = main.ThreadedStore(main.FolderSyncStore(str(tmp_path / "watch.db")))
+    replies = []
+
+    async def reply(self, text):
+        replies.append(text)
+
+    monkeypatch.setattr(main, "work_queue", queue)
+    monkeypatch.setattr(main, "folder_sync_store", store)
+    monkeypatch.setattr(main.ChatContext, "reply", reply)
+    chat = main.ChatContext(chat_id=1, message_id=2, user_id=3, username="user", user_data={})
+
+    async def scenario():
+        # Процесс bot только ставит задачу: его watch.db воркерам не видна
+        monkeypatch.setattr(main, "PROCESS_ROLE", "bot")
+        await main.dispatch_task({"kind": "watch", "folder_id": "folder", "chat": main.asdict(chat)})
+        assert await store.watches(1) == []
+        assert replies == []
+        task, receipt = await queue.get()
+        await main.execute_task(task)
+        await queue.ack(receipt)
+        assert [w['folder_id'] for w in await store.watches(1)] == ["folder"]
+
+    run(scenario())
+    assert len(replies) == 1